@@ -0,0 +1,314 @@
+import gc
+import os
+import sys
+import zlib
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from copy import copy
+from urllib.parse import parse_qs
+
+try:
+    import passwords  # noqa: F401
+except ImportError:
+    # The benchmark never talks to Discord or Twitch, so it runs without real credentials.
+    sys.modules['passwords'] = types.SimpleNamespace(DISCORD_BOT_TOKEN='', TWITCH_CLIENT_ID='benchmark')
+
+import main
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Discord Voice Channel Manager Benchmark',
+                                     description='Replays a synthetic stream of voice and presence events '
+                                                 'against the bot using a fake Discord client and a stub '
+                                                 'Twitch API, then reports throughput and decision latency.')
+    parser.add_argument('--members', help='Members in the fake server', type=int, default=5000)
+    parser.add_argument('--channels', help='Restricted voice channels', type=int, default=200)
+    parser.add_argument('--games', help='Games allowed per restricted channel', type=int, default=3)
+    parser.add_argument('--whitelisted-users', help='Whitelisted user IDs', type=int, default=2000)
+    parser.add_argument('--whitelisted-share', help='Most members that may be whitelisted, as a share of --members',
+                        type=float, default=0.2)
+    parser.add_argument('--whitelisted-roles', help='Whitelisted role IDs', type=int, default=50)
+    parser.add_argument('--events', help='Events to replay', type=int, default=50000)
+    parser.add_argument('--streamer-ratio', help='Share of game changes that are Twitch streams',
+                        type=float, default=0.05)
+    parser.add_argument('--mute-mode', help='Mute members instead of moving them out of restricted channels',
+                        action='store_true')
+    parser.add_argument('--notices', help='Post coalesced notices to a bot text channel', action='store_true')
+    parser.add_argument('--notice-interval', help='Seconds to coalesce notices for', type=float, default=0.05)
+    parser.add_argument('--workers', help='Decide restriction checks in this many worker processes',
+                        type=int, default=0)
+    parser.add_argument('--seed', help='Random seed for the event stream', type=int, default=1)
+    parser.add_argument('--json', help='Print the report as JSON', action='store_true')
+    return parser.parse_args()
+
+
+class FakeRole(object):
+    def __init__(self, role_id):
+        self.id = role_id
+        self.name = f'role-{role_id}'
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGame(object):
+    def __init__(self, name, game_type=0, url=None):
+        self.name = name
+        self.type = game_type
+        self.url = url
+
+
+class FakeVoiceState(object):
+    def __init__(self, voice_channel=None, mute=False):
+        self.voice_channel = voice_channel
+        self.mute = mute
+        self.self_mute = False
+        self.deaf = False
+        self.self_deaf = False
+
+
+class FakeChannel(object):
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = name
+        self.voice_members = []
+
+
+class FakeMember(object):
+    def __init__(self, member_id, server, roles):
+        self.id = member_id
+        self.name = f'member-{member_id}'
+        self.nick = None
+        self.mention = f'<@{member_id}>'
+        self.server = server
+        self.roles = roles
+        self.voice = FakeVoiceState()
+        self.game = None
+
+    def replace(self, voice_channel=False, game=False, mute=None):
+        member = copy(self)
+        member.voice = FakeVoiceState(self.voice.voice_channel if voice_channel is False else voice_channel,
+                                      self.voice.mute if mute is None else mute)
+        if game is not False:
+            member.game = game
+        return member
+
+
+class FakeServer(object):
+    def __init__(self, server_id):
+        self.id = server_id
+        self.name = 'benchmark'
+        self.roles = []
+        self._channels = {}
+        self.members = {}
+
+    @property
+    def channels(self):
+        return list(self._channels.values())
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.servers = []
+        self.channels = {}
+        self.calls = {'move': 0, 'mute': 0, 'message': 0}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_server(self, server_id):
+        return next((server for server in self.servers if server.id == server_id), None)
+
+    async def move_member(self, member, channel):
+        self.calls['move'] += 1
+
+    async def server_voice_state(self, member, mute=False):
+        self.calls['mute'] += 1
+
+    async def send_message(self, channel, content):
+        self.calls['message'] += 1
+
+    async def say(self, content):
+        pass
+
+
+async def stub_twitch(reader, writer):
+    request = (await reader.readline()).decode()
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    path, _, query = request.split(' ')[1].partition('?')
+    params = {key: values[0].split(',') for key, values in parse_qs(query).items()}
+    if path.endswith('/users'):
+        data = {'users': [{'name': login, '_id': str(zlib.crc32(login.encode()))}
+                          for login in params.get('login', [])]}
+    else:
+        data = {'streams': [{'channel': {'_id': channel}, 'game': f'game-{int(channel) % 7}'}
+                            for channel in params.get('channel', [])]}
+    body = json.dumps(data).encode()
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                 b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+    await writer.drain()
+    writer.close()
+
+
+def build_world(args, bot, rng):
+    server = FakeServer('1')
+    bot.servers.append(server)
+    general = FakeChannel('general', 'General')
+    bot.channels[general.id] = general
+    bot_text = FakeChannel('bot-text', 'bot-text')
+    if args.notices:
+        bot.channels[bot_text.id] = bot_text
+    restricted = []
+    for i in range(args.channels):
+        channel = FakeChannel(f'voice-{i}', f'Lobby {i}')
+        bot.channels[channel.id] = channel
+        restricted.append(channel)
+    lounges = [FakeChannel(f'lounge-{i}', f'Lounge {i}') for i in range(max(1, args.channels // 4))]
+    for channel in lounges:
+        bot.channels[channel.id] = channel
+    server._channels.update(bot.channels)
+    roles = [FakeRole(f'role-{i}') for i in range(args.whitelisted_roles * 20)]
+    for i in range(args.members):
+        member = FakeMember(str(i), server, rng.sample(roles, min(len(roles), 3)))
+        server.members[member.id] = member
+
+    whitelisted_users = min(args.whitelisted_users, int(args.members * args.whitelisted_share))
+    settings = main.guilds.get(server).settings
+    settings.settings.update({
+        'enabled': True,
+        'kick_mode': not args.mute_mode,
+        'general_voice_channel_id': general.id,
+        'bot_text_channel_id': bot_text.id if args.notices else '',
+        'game_close_disconnect_timeout': 0,
+        'whitelisted_user_ids': [str(i) for i in rng.sample(range(args.members), whitelisted_users)],
+        'whitelisted_role_ids': [role.id for role in roles[:args.whitelisted_roles]],
+        'restricted_voice_channels': {channel.id: tuple(f'game-{(i + g) % 7}' for g in range(args.games))
+                                      for i, channel in enumerate(restricted)}
+    })
+    settings.save()
+    return server, restricted + lounges
+
+
+def next_event(server, channels, rng, streamer_ratio):
+    member = server.members[str(rng.randrange(len(server.members)))]
+    roll = rng.random()
+    if roll < 0.3:
+        after = member.replace(voice_channel=rng.choice(channels + [None]))
+        handler = main.on_voice_state_update
+    elif roll < 0.8:
+        if rng.random() < streamer_ratio:
+            game = FakeGame(f'stream-{member.id}', 1, f'https://www.twitch.tv/streamer{member.id}')
+        else:
+            game = rng.choice([None, FakeGame(f'game-{rng.randrange(10)}')])
+        after = member.replace(game=game)
+        handler = main.on_member_update
+    elif roll < 0.9:
+        after = member.replace(mute=not member.voice.mute)
+        handler = main.on_voice_state_update
+    else:
+        after = member.replace()
+        handler = main.on_member_update
+    server.members[member.id] = after
+    return handler, member, after
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    bot = FakeBot()
+    main.client = bot
+    main.GuildState.debounce_window = 0
+    main.ActionDispatcher.notice_interval = args.notice_interval
+    main.ActionDispatcher.route_limits = {'members': (10 ** 9, 10 ** 9), 'channel': (10 ** 9, 10 ** 9)}
+    main.Twitch.batch_window = 0.001
+    main.guilds.settings_path = os.path.join(tempfile.mkdtemp(), 'bot_settings.pickle')
+    twitch_server = await asyncio.start_server(stub_twitch, '127.0.0.1', 0)
+    main.twitch.api_url = f'http://127.0.0.1:{twitch_server.sockets[0].getsockname()[1]}'
+    main.twitch.rate_limit = main.TokenBucket(rate=10 ** 9, capacity=10 ** 9)
+    if args.workers > 0:
+        main.decisions.start(args.workers)
+
+    server, channels = build_world(args, bot, rng)
+    events = [next_event(server, channels, rng, args.streamer_ratio) for _ in range(args.events)]
+
+    gc.collect()
+    tracemalloc.start()
+    latencies = []
+    started = time.perf_counter()
+    for handler, before, after in events:
+        server.members[after.id] = after
+        event_started = time.perf_counter()
+        await handler(before, after)
+        latencies.append(time.perf_counter() - event_started)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(max(0.1, 2 * args.notice_interval))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    main.decisions.close()
+    await main.twitch.close()
+    await main.guilds.close()
+    twitch_server.close()
+    latencies.sort()
+    return {
+        'events': args.events,
+        'members': args.members,
+        'restricted_channels': args.channels,
+        'mode': 'mute' if args.mute_mode else 'kick',
+        'seconds': round(elapsed, 3),
+        'events_per_second': round(args.events / elapsed),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'check_mean_ms': round(main.check_seconds.mean() * 1000, 4),
+        'checks': main.check_seconds.count(),
+        'filtered': main.events_total.value(stage='filtered'),
+        'twitch_requests': main.twitch_requests_total.total(),
+        'actions': bot.calls,
+        'peak_memory_kib': round(peak / 1024)
+    }
+
+
+def report(results):
+    print(f'Replayed {results["events"]} events against {results["members"]} members and '
+          f'{results["restricted_channels"]} restricted channels ({results["mode"]} mode) in {results["seconds"]}s')
+    print(f'Throughput:        {results["events_per_second"]} events/s')
+    print(f'Handler latency:   p50 {results["p50_ms"]}ms, p99 {results["p99_ms"]}ms')
+    print(f'Restriction check: {results["checks"]} checks, mean {results["check_mean_ms"]}ms')
+    print(f'Filtered events:   {results["filtered"]}')
+    print(f'Twitch requests:   {results["twitch_requests"]}')
+    print(f'Discord actions:   {results["actions"]}')
+    print(f'Peak memory:       {results["peak_memory_kib"]} KiB')
+
+
+def benchmark():
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,17 +1,39 @@
 import re
 import os
+import io
+import copy
+import time
 import pickle
 import asyncio
+import sqlite3
+import threading
+import discord
+import tempfile
+import aiohttp
+import bisect
+import fnmatch
+import itertools
+import functools
 import logging
-import requests
 import argparse
+import json
+import hashlib
+import queue
+import multiprocessing
 
 from uuid import uuid4
-from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter, OrderedDict
 from discord.ext import commands
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from passwords import DISCORD_BOT_TOKEN, TWITCH_CLIENT_ID
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 
 logger = logging.getLogger(__name__)
 client = commands.Bot(command_prefix='!', description='Setup Access Control to Voice Channels '
@@ -24,25 +46,655 @@ def parse_args():
                                                  'This aids admins in keeping voice channels intended '
                                                  'to be used for game play of specific game(s), clear '
                                                  'of loiters.')
-    parser.add_argument('-s', '--settings', help='Path to stored bot_settings.pickle', default=None)
+    parser.add_argument('-s', '--settings', help='Base path of stored bot_settings.pickle. Each server '
+                                                 'stores its settings next to it as bot_settings.<server_id>.pickle',
+                        default=None)
+    parser.add_argument('-d', '--database', help='Store settings and the enforcement audit log in this SQLite '
+                                                 'database instead of pickle files', default=None)
     parser.add_argument('-l', '--log-file', help='File path to write log file',
                         default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                              'discord_voice_chat_manager.log'))
     parser.add_argument('-L', '--log-level', help='Log Level. Valid Options: DEBUG, INFO',
                         default='INFO')
+    parser.add_argument('--log-format', help='Log Format. Valid Options: text, json',
+                        choices=('text', 'json'), default='text')
+    parser.add_argument('--log-sample-rate', help='Share of DEBUG log records of each kind to keep (0-1)',
+                        type=float, default=1.0)
+    parser.add_argument('-m', '--metrics-port', help='Serve Prometheus metrics on this local port',
+                        type=int, default=None)
+    parser.add_argument('--shard-id', help='Gateway shard handled by this process', type=int, default=None)
+    parser.add_argument('--shard-count', help='Total number of gateway shards', type=int, default=None)
+    parser.add_argument('--runtime-state', help='File to keep pending checks, verdicts and queued actions in '
+                                                'across restarts (defaults to bot_runtime.json next to the settings)',
+                        default=None)
+    parser.add_argument('-r', '--reload-interval', help='Seconds between checks for settings changed outside '
+                                                        'the bot (0 disables)', type=float, default=5)
+    parser.add_argument('--stream-check-interval', help='Seconds between re-validations of Twitch streams in '
+                                                        'restricted channels (0 disables)', type=float, default=120)
+    parser.add_argument('-w', '--workers', help='Decide restriction checks in this many worker processes',
+                        type=int, default=0)
     return parser.parse_args()
 
 
+class StructuredMessage(object):
+    __slots__ = ('event', 'template', 'fields')
+
+    def __init__(self, event, template, fields):
+        self.event = event
+        self.template = template
+        self.fields = fields
+
+    def __str__(self):
+        return self.template.format(**self.fields)
+
+
+def log_event(level, event, template, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, StructuredMessage(event, template, fields))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        if isinstance(record.msg, StructuredMessage):
+            entry['event'] = record.msg.event
+            for k, v in record.msg.fields.items():
+                entry.setdefault(k, v)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._seen = Counter()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        if not self.every:
+            return False
+        key = record.msg.event if isinstance(record.msg, StructuredMessage) else (record.pathname, record.lineno)
+        self._seen[key] += 1
+        return self._seen[key] % self.every == 1
+
+
+class BackgroundQueueHandler(QueueHandler):
+    # Hand records over untouched so message formatting happens on the listener thread.
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        labels = ','.join(f'{k}="{v}"' for k, v in tuple(key) + tuple(extra))
+        return f'{{{labels}}}' if labels else ''
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{self._format_labels(key)} {value}')
+        return '\n'.join(lines)
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+
+class GaugeMetric(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        if self.callback is not None:
+            return self.callback()
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, (), self.callback()
+            return
+        yield from super().samples()
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, buckets=default_buckets):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def mean(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry[1] / entry[2] if entry else 0.0
+
+    def quantile(self, q, **labels):
+        entry = self._values.get(self._key(labels))
+        if not entry:
+            return 0.0
+        cumulative = 0
+        for bound, count in zip(self.buckets, entry[0]):
+            cumulative += count
+            if cumulative >= q * entry[2]:
+                return bound
+        return self.buckets[-1]
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else bound
+                yield f'{self.name}_bucket', key + (('le', le),), cumulative
+            yield f'{self.name}_sum', key, total
+            yield f'{self.name}_count', key, count
+
+
+class Metrics(object):
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(CounterMetric(name, help_text))
+
+    def gauge(self, name, help_text, callback=None):
+        return self._register(GaugeMetric(name, help_text, callback))
+
+    def histogram(self, name, help_text, buckets=HistogramMetric.default_buckets):
+        return self._register(HistogramMetric(name, help_text, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+def timed(histogram):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+metrics = Metrics()
+events_total = metrics.counter('voice_bot_events_total', 'Gateway events by processing stage.')
+check_seconds = metrics.histogram('voice_bot_check_seconds', 'Latency of the restriction check.')
+actions_total = metrics.counter('voice_bot_actions_total', 'Discord actions executed by kind and result.')
+action_seconds = metrics.histogram('voice_bot_action_seconds', 'Latency of Discord API actions.')
+twitch_requests_total = metrics.counter('voice_bot_twitch_requests_total', 'Twitch API requests by endpoint.')
+twitch_request_seconds = metrics.histogram('voice_bot_twitch_request_seconds', 'Latency of Twitch API requests.')
+twitch_validations_total = metrics.counter('voice_bot_twitch_validations_total', 'Twitch validations by result.')
+stream_revalidations_total = metrics.counter('voice_bot_stream_revalidations_total',
+                                             'Periodic Twitch stream re-validations by result.')
+worker_decisions_total = metrics.counter('voice_bot_worker_decisions_total', 'Worker process decisions by result.')
+settings_save_seconds = metrics.histogram('voice_bot_settings_save_seconds', 'Duration of settings writes.')
+loop_lag_seconds = metrics.gauge('voice_bot_event_loop_lag_seconds', 'Most recently measured event loop lag.')
+
+
+async def monitor_event_loop_lag(interval=1):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.set(max(0, time.monotonic() - started - interval))
+
+
+async def serve_metrics(reader, writer):
+    try:
+        await reader.readline()
+        body = metrics.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+game_name_punctuation = re.compile(r'[^\w\s]+')
+
+
+def normalize_game_name(name):
+    return ' '.join(game_name_punctuation.sub(' ', (name or '').casefold()).split())
+
+
+def compile_game_aliases(aliases):
+    return {normalize_game_name(alias): normalize_game_name(game) for alias, game in aliases.items()}
+
+
+class GameMatcher(object):
+    __slots__ = ('aliases', 'names', 'trie')
+
+    terminal = None
+
+    def __init__(self, games, aliases):
+        self.aliases = aliases
+        self.names = set()
+        self.trie = {}
+        for game in games:
+            configured = normalize_game_name(game)
+            for name in {configured, aliases.get(configured, configured)}:
+                if not name:
+                    continue
+                self.names.add(name)
+                node = self.trie
+                for token in name.split(' '):
+                    node = node.setdefault(token, {})
+                node[self.terminal] = True
+
+    def matches(self, game_name):
+        name = normalize_game_name(game_name)
+        name = self.aliases.get(name, name)
+        if name in self.names:
+            return True
+        node = self.trie
+        for token in name.split(' '):
+            node = node.get(token)
+            if node is None:
+                return False
+            if self.terminal in node:
+                return True
+        return False
+
+
+class ChannelPolicy(object):
+    __slots__ = ('channel_id', 'games', 'games_display', 'kick_mode',
+                 'target_channel_id', 'notify_channel_id', 'notification')
+
+    kick_notification = ('{mention} You must be playing the following to join {channel}: {games}. '
+                         'If you are streaming, I am only friends with Twitch for right now and am unable '
+                         'to determine what game you are currently playing outside of my friends list. :( ')
+    mute_notification = ('{mention} You must be playing the following to not be muted in {channel}: {games}. '
+                         'If you are streaming, I am only friends with Twitch for right now and am unable '
+                         'to determine what game you are currently playing outside of my friends list. :( ')
+
+    def __init__(self, channel_id, games, settings, aliases=None, matcher=None):
+        self.channel_id = channel_id
+        self.games = matcher if matcher is not None else GameMatcher(games, aliases or {})
+        self.games_display = ','.join(games)
+        self.kick_mode = settings['kick_mode']
+        self.target_channel_id = settings['general_voice_channel_id']
+        self.notify_channel_id = settings['bot_text_channel_id']
+        template = self.kick_notification if self.kick_mode else self.mute_notification
+        self.notification = template.replace('{games}', self.games_display.replace('{', '{{').replace('}', '}}'))
+
+    def allows(self, game_name):
+        return self.games.matches(game_name)
+
+
+def is_voice_channel(channel):
+    return str(getattr(channel, 'type', 'voice')) == 'voice'
+
+
+class PolicySet(object):
+    __slots__ = ('version', 'enabled', 'kick_mode', 'whitelisted_user_ids', 'whitelisted_role_ids', 'channels',
+                 'explicit_channel_ids', 'patterns', '_settings', '_aliases', '_matchers')
+
+    def __init__(self, settings, version=0, channels=()):
+        self.version = version
+        self.enabled = settings['enabled']
+        self.kick_mode = settings['kick_mode']
+        self.whitelisted_user_ids = frozenset(settings['whitelisted_user_ids'])
+        self.whitelisted_role_ids = frozenset(settings['whitelisted_role_ids'])
+        self._settings = settings
+        self._aliases = compile_game_aliases(settings['game_aliases'])
+        self._matchers = {}
+        self.channels = {channel_id: ChannelPolicy(channel_id, games, settings, matcher=self._matcher(games))
+                         for channel_id, games in settings['restricted_voice_channels'].items()}
+        self.explicit_channel_ids = frozenset(self.channels)
+        self.patterns = [(pattern.casefold(), games)
+                         for pattern, games in settings['restricted_channel_patterns'].items()]
+        if self.patterns:
+            for channel in channels:
+                self.index_channel(channel)
+
+    def _matcher(self, games):
+        key = tuple(games)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = self._matchers[key] = GameMatcher(games, self._aliases)
+        return matcher
+
+    def rule_games(self, channel):
+        name = (channel.name or '').casefold()
+        for pattern, games in self.patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return games
+        return None
+
+    def index_channel(self, channel):
+        if channel.id in self.explicit_channel_ids:
+            return False
+        games = self.rule_games(channel) if is_voice_channel(channel) else None
+        if games is None:
+            return self.channels.pop(channel.id, None) is not None
+        matcher = self._matcher(games)
+        current = self.channels.get(channel.id)
+        if current is not None and current.games is matcher:
+            return False
+        self.channels[channel.id] = ChannelPolicy(channel.id, games, self._settings, matcher=matcher)
+        return True
+
+    def unindex_channel(self, channel_id):
+        if channel_id in self.explicit_channel_ids:
+            return False
+        return self.channels.pop(channel_id, None) is not None
+
+    def whitelisted_role(self, member):
+        for role in member.roles:
+            if role.id in self.whitelisted_role_ids:
+                return role
+        return None
+
+    def channel_policy(self, member):
+        if member.voice is None or member.voice.voice_channel is None:
+            return None
+        return self.channels.get(member.voice.voice_channel.id)
+
+
+def atomic_write(file_path, data, prefix='.tmp.'):
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def settings_digest(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=list).encode()).hexdigest()
+
+
+class PickleSettingsStore(object):
+    executor = None
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def __str__(self):
+        return self.file_path
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        if not self.exists():
+            return None
+        with open(self.file_path, 'rb') as settings_file:
+            return pickle.load(settings_file)
+
+    def prepare(self, settings, changes):
+        return pickle.dumps(settings)
+
+    def write(self, data):
+        atomic_write(self.file_path, data, prefix='.bot_settings.')
+
+
+class SettingsDatabase(object):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS settings (server_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+        'PRIMARY KEY (server_id, key))',
+        'CREATE TABLE IF NOT EXISTS whitelist (server_id TEXT NOT NULL, kind TEXT NOT NULL, '
+        'object_id TEXT NOT NULL, PRIMARY KEY (server_id, kind, object_id))',
+        'CREATE TABLE IF NOT EXISTS restrictions (server_id TEXT NOT NULL, channel_id TEXT NOT NULL, '
+        'games TEXT NOT NULL, PRIMARY KEY (server_id, channel_id))',
+        'CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY, time REAL NOT NULL, server_id TEXT NOT NULL, '
+        'member_id TEXT, channel_id TEXT, action TEXT NOT NULL, result TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS revisions (server_id TEXT NOT NULL PRIMARY KEY, revision INTEGER NOT NULL)'
+    ) + tuple(
+        # Every change to a server's settings, from the bot or by hand, bumps that server's revision in the
+        # same transaction, so other servers and the audit log never look changed.
+        f'CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_revision AFTER {event} ON {table} BEGIN '
+        f'INSERT INTO revisions SELECT {row}.server_id, 0 '
+        f'WHERE NOT EXISTS (SELECT 1 FROM revisions WHERE server_id = {row}.server_id); '
+        f'UPDATE revisions SET revision = revision + 1 WHERE server_id = {row}.server_id; END'
+        for table in ('settings', 'whitelist', 'restrictions')
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.schema:
+            self._connection.execute(statement)
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def transaction(self, operations):
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                for sql, params in operations:
+                    self._connection.execute(sql, params)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self._connection.close()
+
+
+class SQLiteSettingsStore(object):
+    list_kinds = {'whitelisted_user_ids': 'user', 'whitelisted_role_ids': 'role'}
+
+    def __init__(self, database, server_id):
+        self.database = database
+        self.server_id = server_id
+
+    def __str__(self):
+        return f'{self.database.path} (server {self.server_id})'
+
+    @property
+    def executor(self):
+        return self.database.executor
+
+    def exists(self):
+        return bool(self.database.query('SELECT 1 FROM settings WHERE server_id = ? LIMIT 1', (self.server_id,)))
+
+    def stamp(self):
+        rows = self.database.query('SELECT revision FROM revisions WHERE server_id = ?', (self.server_id,))
+        return rows[0][0] if rows else None
+
+    def load(self):
+        if not self.exists():
+            return None
+        settings = {key: json.loads(value) for key, value in self.database.query(
+            'SELECT key, value FROM settings WHERE server_id = ?', (self.server_id,))}
+        for key, kind in self.list_kinds.items():
+            settings[key] = [object_id for object_id, in self.database.query(
+                'SELECT object_id FROM whitelist WHERE server_id = ? AND kind = ? ORDER BY rowid',
+                (self.server_id, kind))]
+        settings['restricted_voice_channels'] = {channel_id: tuple(json.loads(games)) for channel_id, games in
+                                                 self.database.query('SELECT channel_id, games FROM restrictions '
+                                                                     'WHERE server_id = ?', (self.server_id,))}
+        return settings
+
+    def _replace(self, settings):
+        operations = [(f'DELETE FROM {table} WHERE server_id = ?', (self.server_id,))
+                      for table in ('settings', 'whitelist', 'restrictions')]
+        for key, value in settings.items():
+            if key in self.list_kinds:
+                operations.extend(self._change('whitelist', self.list_kinds[key], object_id) for object_id in value)
+            elif key == 'restricted_voice_channels':
+                operations.extend(self._change('restrict', channel_id, games) for channel_id, games in value.items())
+            else:
+                operations.append(self._change('set', key, value))
+        return operations
+
+    def _change(self, kind, key, value):
+        if kind == 'set':
+            return 'INSERT OR REPLACE INTO settings VALUES (?, ?, ?)', (self.server_id, key, json.dumps(value))
+        if kind == 'whitelist':
+            return 'INSERT OR IGNORE INTO whitelist VALUES (?, ?, ?)', (self.server_id, key, value)
+        if kind == 'unwhitelist':
+            return ('DELETE FROM whitelist WHERE server_id = ? AND kind = ? AND object_id = ?',
+                    (self.server_id, key, value))
+        if kind == 'restrict':
+            return 'INSERT OR REPLACE INTO restrictions VALUES (?, ?, ?)', (self.server_id, key, json.dumps(list(value)))
+        if kind == 'release':
+            return 'DELETE FROM restrictions WHERE server_id = ? AND channel_id = ?', (self.server_id, key)
+        raise ValueError(f'Unknown settings change: {kind}')
+
+    def prepare(self, settings, changes):
+        if any(kind == 'replace' for kind, _, _ in changes):
+            return self._replace(settings)
+        return [self._change(*change) for change in changes]
+
+    def write(self, operations):
+        self.database.transaction(operations)
+
+
+class AuditLog(object):
+    flush_interval = 5
+    batch_size = 200
+
+    def __init__(self, database=None):
+        self.database = database
+        self._rows = []
+        self._flush_handle = None
+        self._flush_future = None
+
+    def record(self, server_id, action, result):
+        if self.database is None:
+            return
+        self._rows.append((time.time(), server_id, action.member_id, action.channel_id, action.kind, result))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def _insert(self, rows):
+        self.database.transaction(('INSERT INTO audit (time, server_id, member_id, channel_id, action, result) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', row) for row in rows)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        self._flush_future = asyncio.get_event_loop().run_in_executor(self.database.executor, self._insert, rows)
+
+    async def close(self):
+        if self.database is None:
+            return
+        self.flush()
+        if self._flush_future is not None:
+            await asyncio.wait([self._flush_future])
+
+
 class BotSettings(object):
     _settings = None
+    _policy = None
+    _stamp = None
+    _transaction_depth = 0
+    channel_source = None
+    version = 0
     claim_code = None
-
-    def __init__(self, file_path=None):
-        if file_path is None:
-            file_path = 'bot_settings.pickle'
-            self.path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                     file_path)
-        self.file_path = file_path
+    _versions = itertools.count(1)
+    save_delay = 2
+
+    def __init__(self, file_path=None, store=None):
+        if store is None:
+            if file_path is None:
+                file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                         'bot_settings.pickle')
+            store = PickleSettingsStore(file_path)
+        self.store = store
+        self._changes = []
+        self._dirty = False
+        self._save_handle = None
+        self._save_future = None
 
     @property
     def default_settings(self):
@@ -55,7 +707,9 @@ class BotSettings(object):
             'game_close_disconnect_timeout': 30,
             'whitelisted_role_ids': [],
             'whitelisted_user_ids': [],
-            'restricted_voice_channels': {}
+            'restricted_voice_channels': {},
+            'restricted_channel_patterns': {},
+            'game_aliases': {}
         }
 
     @property
@@ -100,6 +754,14 @@ class BotSettings(object):
     def restricted_voice_channels(self):
         return self.settings['restricted_voice_channels']
 
+    @property
+    def restricted_channel_patterns(self):
+        return self.settings['restricted_channel_patterns']
+
+    @property
+    def game_aliases(self):
+        return self.settings['game_aliases']
+
     @property
     def claimed(self):
         return bool(self.bot_admin_role_id)
@@ -111,8 +773,8 @@ class BotSettings(object):
         if claim_code != self.claim_code:
             logger.info(f'Claim Code Mismatch: {self.claimed} != {claim_code}')
             return False
-        self._settings['bot_admin_role_id'] = role_id
-        self.save()
+        self.settings['bot_admin_role_id'] = role_id
+        self.save(('set', 'bot_admin_role_id', role_id))
         return True
 
     def authorize_command(self, author):
@@ -120,229 +782,1629 @@ class BotSettings(object):
             return False
         return any(role.id == self.bot_admin_role_id for role in author.roles)
 
+    def _channels(self):
+        return list(self.channel_source()) if self.channel_source is not None else []
+
+    @property
+    def policy(self):
+        if self._policy is None:
+            self._policy = PolicySet(self.settings, self.version, self._channels())
+        return self._policy
+
+    def _rebuild_indexes(self):
+        self.version = next(self._versions)
+        self._policy = PolicySet(self._settings, self.version, self._channels())
+
+    def index_channel(self, channel):
+        policy = self.policy
+        if policy.index_channel(channel):
+            self.version = policy.version = next(self._versions)
+            return channel.id in policy.channels
+        return False
+
+    def unindex_channel(self, channel_id):
+        policy = self.policy
+        if policy.unindex_channel(channel_id):
+            self.version = policy.version = next(self._versions)
+
     def load(self):
-        if not os.path.exists(self.file_path):
+        self._stamp = self.store.stamp()
+        self._settings = self.store.load()
+        if self._settings is None:
             self._settings = self.default_settings
-            return
-        with open(self.file_path, 'rb') as settings_file:
-            self._settings = pickle.load(settings_file)
+            self._changes.append(('replace', None, None))
         for k, v in self.default_settings.items():
             if k not in self._settings:
                 self._settings[k] = v
+        self._rebuild_indexes()
+
+    def replace(self, settings):
+        self._settings = dict(self.default_settings, **settings)
+        self.save(('replace', None, None))
+
+    def changed_externally(self):
+        return self.store.stamp() != self._stamp
+
+    def _read(self, channels):
+        stamp = self.store.stamp()
+        settings = self.store.load()
+        if settings is None:
+            return stamp, None, None
+        settings = dict(self.default_settings, **settings)
+        return stamp, settings, PolicySet(settings, next(self._versions), channels)
+
+    async def reload(self, force=False):
+        loop = asyncio.get_event_loop()
+        if self._save_future is not None and not self._save_future.done():
+            await asyncio.wait([self._save_future])
+            # The change we were woken up for may have been our own save finishing.
+            if not force and not await loop.run_in_executor(self.store.executor, self.changed_externally):
+                return False
+        stamp, settings, policy = await loop.run_in_executor(self.store.executor, self._read, self._channels())
+        if settings is None:
+            return False
+        if self._dirty:
+            logger.warning(f'Discarding unsaved settings changes, {self.store} was changed outside the bot')
+            if self._save_handle is not None:
+                self._save_handle.cancel()
+                self._save_handle = None
+            self._changes = []
+            self._dirty = False
+        self._settings, self._policy, self.version, self._stamp = settings, policy, policy.version, stamp
+        return True
 
-    def save(self):
-        with open(self.file_path, 'wb') as settings_file:
-            self._settings = pickle.dump(self._settings, settings_file)
+    def _write(self, data):
+        with settings_save_seconds.time():
+            self.store.write(data)
+            self._stamp = self.store.stamp()
+
+    def _prepare_write(self):
+        changes, self._changes = self._changes, []
+        self._dirty = False
+        return self.store.prepare(self._settings, changes)
+
+    def _on_saved(self, future):
+        if future.exception() is not None:
+            logger.error(f'Failed to save settings to {self.store}: {future.exception()!r}')
+            self._changes.insert(0, ('replace', None, None))
+            self._dirty = True
+            self._schedule_save(asyncio.get_event_loop())
+
+    def _flush_in_background(self):
+        self._save_handle = None
+        loop = asyncio.get_event_loop()
+        if self._transaction_depth or self._save_future is not None and not self._save_future.done():
+            self._schedule_save(loop)
+            return
+        if not self._dirty:
+            return
+        self._save_future = loop.run_in_executor(self.store.executor, self._write, self._prepare_write())
+        self._save_future.add_done_callback(self._on_saved)
+
+    def _schedule_save(self, loop):
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(self.save_delay, self._flush_in_background)
+
+    def save(self, *changes):
+        self._changes.extend(changes)
+        self._dirty = True
+        if self._transaction_depth:
+            return
+        self._rebuild_indexes()
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            self.flush()
+            return
+        self._schedule_save(loop)
+
+    @contextmanager
+    def transaction(self):
+        if self._transaction_depth:
+            yield self
+            return
+        settings, changes, dirty = copy.deepcopy(self.settings), list(self._changes), self._dirty
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._settings, self._changes, self._dirty = settings, changes, dirty
+            raise
+        finally:
+            self._transaction_depth -= 1
+        if len(self._changes) != len(changes):
+            self.save()
+
+    def apply_policy(self, policy):
+        with self.transaction():
+            self.settings.update(policy)
+            self.save(('replace', None, None))
+
+    def flush(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._dirty:
+            self._write(self._prepare_write())
+
+    async def close(self):
+        if self._save_future is not None:
+            await asyncio.wait([self._save_future])
+        self.flush()
 
     def set_setting(self, setting, value):
-        if setting not in self._settings:
+        if setting not in self.settings:
             return False
-        self.load()
         self._settings[setting] = value
-        self.save()
+        self.save(('set', setting, value))
         return True
 
     def set_enabled(self, enabled=True):
-        self.load()
-        self._settings['enabled'] = enabled
-        self.save()
+        self.settings['enabled'] = enabled
+        self.save(('set', 'enabled', enabled))
         return self.enabled
 
     def set_kick_mode(self, kick=True):
-        self.load()
-        self._settings['kick_mode'] = kick
-        self.save()
+        self.settings['kick_mode'] = kick
+        self.save(('set', 'kick_mode', kick))
         return self.kick_mode
 
     def set_general_voice_channel_id(self, channel_id):
-        self.load()
-        self._settings['general_voice_channel_id'] = channel_id
-        self.save()
+        self.settings['general_voice_channel_id'] = channel_id
+        self.save(('set', 'general_voice_channel_id', channel_id))
         return True
 
     def set_bot_text_channel_id(self, channel_id):
-        self.load()
-        self._settings['bot_text_channel_id'] = channel_id
-        self.save()
+        self.settings['bot_text_channel_id'] = channel_id
+        self.save(('set', 'bot_text_channel_id', channel_id))
         return True
 
     def set_game_close_disconnect_timeout(self, timeout: int):
         if timeout < 0:
             return False
-        self.load()
-        self._settings['game_close_disconnect_timeout'] = timeout
-        self.save()
+        self.settings['game_close_disconnect_timeout'] = timeout
+        self.save(('set', 'game_close_disconnect_timeout', timeout))
         return True
 
     def whitelist_user(self, user_id, remove=False):
         if not remove and user_id not in self.whitelisted_user_ids:
-            self._settings['whitelisted_user_ids'].append(user_id)
-            self.save()
+            self.settings['whitelisted_user_ids'].append(user_id)
+            self.save(('whitelist', 'user', user_id))
             return True
         if remove and user_id in self.whitelisted_user_ids:
-            self._settings['whitelisted_user_ids'].remove(user_id)
-            self.save()
+            self.settings['whitelisted_user_ids'].remove(user_id)
+            self.save(('unwhitelist', 'user', user_id))
             return True
         return False
 
     def whitelist_role(self, role_id, remove=False):
         if not remove and role_id not in self.whitelisted_role_ids:
-            self._settings['whitelisted_role_ids'].append(role_id)
-            self.save()
+            self.settings['whitelisted_role_ids'].append(role_id)
+            self.save(('whitelist', 'role', role_id))
             return True
         if remove and role_id in self.whitelisted_role_ids:
-            self._settings['whitelisted_role_ids'].remove(role_id)
-            self.save()
+            self.settings['whitelisted_role_ids'].remove(role_id)
+            self.save(('unwhitelist', 'role', role_id))
             return True
         return False
 
     def restrict_channel(self, channel_id, games):
-        self.load()
-        self._settings['restricted_voice_channels'][channel_id] = games
-        self.save()
+        self.settings['restricted_voice_channels'][channel_id] = games
+        self.save(('restrict', channel_id, games))
         return True
 
     def release_channel(self, channel_id):
         if channel_id not in self.restricted_voice_channels:
             return False
-        del self._settings['restricted_voice_channels'][channel_id]
-        self.save()
+        del self.settings['restricted_voice_channels'][channel_id]
+        self.save(('release', channel_id, None))
         return True
 
+    def restrict_pattern(self, pattern, games):
+        self.settings['restricted_channel_patterns'][pattern] = games
+        self.save(('set', 'restricted_channel_patterns', self.restricted_channel_patterns))
+        return True
+
+    def release_pattern(self, pattern):
+        if pattern not in self.restricted_channel_patterns:
+            return False
+        del self.settings['restricted_channel_patterns'][pattern]
+        self.save(('set', 'restricted_channel_patterns', self.restricted_channel_patterns))
+        return True
+
+    def alias_game(self, alias, game):
+        if not normalize_game_name(alias) or not normalize_game_name(game):
+            return False
+        self.settings['game_aliases'][alias] = game
+        self.save(('set', 'game_aliases', self.game_aliases))
+        return True
+
+    def remove_game_alias(self, alias):
+        if alias not in self.game_aliases:
+            return False
+        del self.settings['game_aliases'][alias]
+        self.save(('set', 'game_aliases', self.game_aliases))
+        return True
 
-class Twitch(object):
-    _last_api_call = None
 
-    def validate_twitch_game(self, twitch_username, voice_channel_id):
-        if self._last_api_call is None:
-            self._last_api_call = datetime.utcnow()
-        elif (datetime.utcnow() - self._last_api_call).seconds > 5:
-            self._last_api_call = datetime.utcnow()
+policy_file_keys = ('enabled', 'kick_mode', 'general_voice_channel_id', 'bot_text_channel_id',
+                    'game_close_disconnect_timeout', 'whitelisted_user_ids', 'whitelisted_role_ids',
+                    'restricted_voice_channels', 'restricted_channel_patterns',
+                    'game_aliases')
+
+
+def _policy_id(key, value):
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError(f'{key}: expected an ID, got {value!r}')
+    return str(value)
+
+
+def _policy_games(key, value):
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not value \
+            or not all(isinstance(game, str) and normalize_game_name(game) for game in value):
+        raise ValueError(f'{key}: expected a list of game names, got {value!r}')
+    return tuple(value)
+
+
+def _policy_game_name(key, value):
+    if not isinstance(value, str) or not normalize_game_name(value):
+        raise ValueError(f'{key}: expected a game name, got {value!r}')
+    return value
+
+
+def _policy_mapping(key, value):
+    if not isinstance(value, dict):
+        raise ValueError(f'{key}: expected a mapping, got {value!r}')
+    return value.items()
+
+
+def validate_policy(document):
+    if not isinstance(document, dict):
+        raise ValueError('The policy file must contain a mapping of settings.')
+    unknown = set(document) - set(policy_file_keys)
+    if unknown:
+        raise ValueError(f'Unknown setting(s): {", ".join(sorted(map(str, unknown)))}')
+    policy = {}
+    for key, value in document.items():
+        if key in ('enabled', 'kick_mode'):
+            if not isinstance(value, bool):
+                raise ValueError(f'{key}: expected true or false, got {value!r}')
+        elif key == 'game_close_disconnect_timeout':
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ValueError(f'{key}: expected a number of seconds, got {value!r}')
+        elif key in ('general_voice_channel_id', 'bot_text_channel_id'):
+            value = '' if value is None else _policy_id(key, value)
+        elif key in ('whitelisted_user_ids', 'whitelisted_role_ids'):
+            if not isinstance(value, list):
+                raise ValueError(f'{key}: expected a list of IDs, got {value!r}')
+            value = list(OrderedDict.fromkeys(_policy_id(key, object_id) for object_id in value))
+        elif key == 'restricted_channel_patterns':
+            value = {str(pattern): _policy_games(f'{key}.{pattern}', games)
+                     for pattern, games in _policy_mapping(key, value)}
+        elif key == 'game_aliases':
+            value = {_policy_game_name(key, alias): _policy_game_name(f'{key}.{alias}', game)
+                     for alias, game in _policy_mapping(key, value)}
         else:
-            logger.warning(f'UNABLE TO HIT TWITCH API. INTERNAL RATE LIMIT REACHED! {twitch_username}')
+            value = {_policy_id(key, object_id): _policy_games(f'{key}.{object_id}', games)
+                     for object_id, games in _policy_mapping(key, value)}
+        policy[key] = value
+    return policy
+
+
+def check_policy_channels(server, settings, policy):
+    result = dict(settings, **policy)
+    if result['enabled'] and not result['general_voice_channel_id']:
+        raise ValueError('Restrictions cannot be enabled without a general_voice_channel_id.')
+    channels = [('general_voice_channel_id', result['general_voice_channel_id'], True),
+                ('bot_text_channel_id', result['bot_text_channel_id'], False)]
+    channels.extend(('restricted_voice_channels', channel_id, True)
+                    for channel_id in result['restricted_voice_channels'])
+    for key, channel_id, voice in channels:
+        if not channel_id:
+            continue
+        channel = server.get_channel(channel_id)
+        if channel is None:
+            raise ValueError(f'{key}: no channel {channel_id} on this server')
+        if is_voice_channel(channel) != voice:
+            raise ValueError(f'{key}: {channel.name} is not a {"voice" if voice else "text"} channel')
+
+
+def export_policy(settings):
+    document = {}
+    for key in policy_file_keys:
+        value = settings.settings[key]
+        if isinstance(value, dict):
+            value = {k: list(v) if isinstance(v, tuple) else v for k, v in value.items()}
+        elif isinstance(value, list):
+            value = list(value)
+        document[key] = value
+    return document
+
+
+def parse_policy_file(filename, data):
+    if filename.lower().endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ValueError('YAML policy files need PyYAML installed. Use JSON instead.')
+        try:
+            return yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            raise ValueError(f'Invalid YAML: {e}')
+    try:
+        return json.loads(data.decode())
+    except ValueError as e:
+        raise ValueError(f'Invalid JSON: {e}')
+
+
+class LRUCache(object):
+    _missing = object()
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key, self._missing)
+        return entry is not self._missing and self._valid(key, entry)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate}
+
+    def _valid(self, key, entry):
+        return True
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, self._missing)
+        if entry is self._missing or not self._valid(key, entry):
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        entry = self._data.get(key, self._missing)
+        if entry is self._missing or not self._valid(key, entry):
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, self._missing)
+        return default if entry is self._missing else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+
+class TTLCache(LRUCache):
+    def __init__(self, max_size=1024, ttl=60):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def _valid(self, key, entry):
+        if time.monotonic() - entry[1] < self.ttl:
+            return True
+        del self._data[key]
+        return False
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens=1):
+        self._refill()
+        blocked = self._blocked_until - time.monotonic()
+        if blocked > 0:
+            return blocked
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        if self.delay(tokens):
             return False
-        headers = {
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def block_for(self, seconds):
+        self.tokens = 0
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class TwitchAPIError(Exception):
+    pass
+
+
+class MemberTimers(object):
+    def __init__(self):
+        self._timers = {}
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, member_id):
+        return member_id in self._timers
+
+    def schedule(self, member_id, delay, callback, *args):
+        if member_id in self._timers:
+            return False
+        loop = asyncio.get_event_loop()
+        self._timers[member_id] = loop.call_later(delay, self._fire, member_id, callback, args)
+        return True
+
+    def _fire(self, member_id, callback, args):
+        del self._timers[member_id]
+        asyncio.ensure_future(callback(*args))
+
+    def cancel(self, member_id):
+        handle = self._timers.pop(member_id, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        return True
+
+    def cancel_all(self):
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers.clear()
+
+    def deadlines(self):
+        offset = time.time() - asyncio.get_event_loop().time()
+        return {member_id: handle.when() + offset for member_id, handle in self._timers.items()}
+
+
+class Action(object):
+    __slots__ = ('kind', 'server_id', 'member_id', 'channel_id', 'content', 'source_channel_id', 'action_id')
+
+    def __init__(self, kind, server_id, member_id=None, channel_id=None, content=None, source_channel_id=None,
+                 action_id=None):
+        self.kind = kind
+        self.server_id = server_id
+        self.member_id = member_id
+        self.channel_id = channel_id
+        self.content = content
+        self.source_channel_id = source_channel_id
+        self.action_id = action_id if action_id is not None else uuid4().hex
+
+    def dump(self):
+        return [self.kind, self.server_id, self.member_id, self.channel_id, self.content, self.source_channel_id,
+                self.action_id]
+
+    @property
+    def key(self):
+        return self.kind, self.member_id, self.channel_id, self.content
+
+    @property
+    def route(self):
+        if self.kind == 'message':
+            return f'channel:{self.channel_id}'
+        return 'members'
+
+    def __repr__(self):
+        return f'<Action {self.kind} member={self.member_id} channel={self.channel_id}>'
+
+
+class ActionDispatcher(object):
+    enforcement_priority = 0
+    restore_priority = 1
+    notice_priority = 2
+    notice_interval = 2
+    max_message_length = 2000
+    completed_history = 1024
+    route_limits = {
+        'members': (1, 10),
+        'channel': (1, 5)
+    }
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self._routes = {}
+        self._pending = set()
+        self._queued = OrderedDict()
+        self._completed = OrderedDict()
+        self._notices = OrderedDict()
+        self._notice_handle = None
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return sum(queue.qsize() for queue, _, _ in self._routes.values())
+
+    def _route(self, name):
+        route = self._routes.get(name)
+        if route is None:
+            rate, capacity = self.route_limits[name.split(':')[0]]
+            queue = asyncio.PriorityQueue()
+            bucket = TokenBucket(rate=rate, capacity=capacity)
+            route = self._routes[name] = (queue, bucket, asyncio.ensure_future(self._run(queue, bucket)))
+        return route
+
+    def enqueue(self, action, priority=enforcement_priority):
+        if action.key in self._pending or action.action_id in self._completed:
+            return False
+        self._pending.add(action.key)
+        self._queued[action.action_id] = priority, action
+        queue, _, _ = self._route(action.route)
+        queue.put_nowait((priority, next(self._sequence), action))
+        return True
+
+    def move(self, member, channel_id):
+        return self.enqueue(Action('move', self.server_id, member.id, channel_id,
+                                   source_channel_id=voice_channel_id(member)))
+
+    def mute(self, member, mute=True):
+        if mute:
+            return self.enqueue(Action('mute', self.server_id, member.id))
+        return self.enqueue(Action('unmute', self.server_id, member.id), self.restore_priority)
+
+    def notify(self, policy, member, channel_name):
+        key = (policy.notify_channel_id, policy.notification, channel_name)
+        mentions = self._notices.setdefault(key, [])
+        if member.mention not in mentions:
+            mentions.append(member.mention)
+        if self._notice_handle is None:
+            self._notice_handle = asyncio.get_event_loop().call_later(self.notice_interval, self._flush_notices)
+
+    def _flush_notices(self):
+        self._notice_handle = None
+        notices, self._notices = self._notices, OrderedDict()
+        for (channel_id, template, channel_name), mentions in notices.items():
+            budget = self.max_message_length - len(template.format(mention='', channel=channel_name))
+            chunk = []
+            for mention in mentions:
+                if chunk and len(' '.join(chunk + [mention])) > budget:
+                    self._enqueue_notice(channel_id, template, channel_name, chunk)
+                    chunk = []
+                chunk.append(mention)
+            self._enqueue_notice(channel_id, template, channel_name, chunk)
+
+    def _enqueue_notice(self, channel_id, template, channel_name, mentions):
+        content = template.format(mention=' '.join(mentions), channel=channel_name)
+        self.enqueue(Action('message', self.server_id, channel_id=channel_id, content=content), self.notice_priority)
+
+    def _acknowledge(self, action):
+        self._queued.pop(action.action_id, None)
+        self._completed[action.action_id] = None
+        if len(self._completed) > self.completed_history:
+            self._completed.popitem(last=False)
+
+    def dump(self):
+        return {'actions': [[priority] + action.dump() for priority, action in self._queued.values()],
+                'completed': list(self._completed)}
+
+    def restore(self, data):
+        for action_id in data['completed']:
+            self._completed[action_id] = None
+        restored = sum(self.enqueue(Action(*fields), priority) for priority, *fields in data['actions'])
+        if restored:
+            logger.info(f'Restored {restored} queued action(s) for server {self.server_id}.')
+
+    async def _run(self, queue, bucket):
+        while True:
+            _, _, action = await queue.get()
+            await bucket.acquire()
+            self._pending.discard(action.key)
+            try:
+                with action_seconds.time(kind=action.kind):
+                    result = 'ok' if await self._execute(action) else 'skipped'
+                actions_total.inc(kind=action.kind, result=result)
+                audit_log.record(self.server_id, action, result)
+            except discord.HTTPException as e:
+                actions_total.inc(kind=action.kind, result='error')
+                audit_log.record(self.server_id, action, 'error')
+                logger.warning('Discord rejected %r: %r', action, e)
+            except Exception:
+                actions_total.inc(kind=action.kind, result='error')
+                audit_log.record(self.server_id, action, 'error')
+                logger.exception(f'Failed to execute {action!r}')
+            finally:
+                self._acknowledge(action)
+
+    async def _execute(self, action):
+        # Actions may be replayed after a restart, so only act if the member is still in the state that caused them.
+        server = client.get_server(action.server_id)
+        if server is None:
+            return False
+        if action.kind == 'message':
+            channel = server.get_channel(action.channel_id)
+            if channel is None:
+                return False
+            await client.send_message(channel, action.content)
+            return True
+        member = server.get_member(action.member_id)
+        if member is None:
+            return False
+        if action.kind == 'move':
+            channel = server.get_channel(action.channel_id)
+            if channel is None or voice_channel_id(member) != action.source_channel_id:
+                return False
+            await client.move_member(member, channel)
+            return True
+        mute = action.kind == 'mute'
+        if member.voice is None or member.voice.mute == mute:
+            return False
+        await client.server_voice_state(member, mute=mute)
+        return True
+
+    async def close(self):
+        if self._notice_handle is not None:
+            self._notice_handle.cancel()
+            self._notice_handle = None
+        if len(self):
+            logger.warning(f'Dropping {len(self)} queued action(s) for server {self.server_id}.')
+        for _, _, worker in self._routes.values():
+            worker.cancel()
+        self._routes.clear()
+        self._pending.clear()
+        self._queued.clear()
+        self._notices.clear()
+
+
+class MemberSnapshot(object):
+    __slots__ = ('voice_channel_id', 'role_ids', 'game', 'verdict', 'version')
+
+    def __init__(self, member):
+        voice = member.voice
+        self.voice_channel_id = voice.voice_channel.id if voice is not None and voice.voice_channel else None
+        self.role_ids = frozenset(role.id for role in member.roles)
+        game = member.game
+        self.game = (game.name, game.type, game.url) if game is not None else None
+        self.verdict = None
+        self.version = None
+
+    def same_inputs(self, other):
+        return self.voice_channel_id == other.voice_channel_id and self.game == other.game \
+            and self.role_ids == other.role_ids
+
+    def remember(self, verdict, policies):
+        self.verdict = verdict
+        self.version = policies.version
+
+    def dump(self):
+        return [self.voice_channel_id, sorted(self.role_ids), self.game, self.verdict]
+
+    @classmethod
+    def restore(cls, fields, version):
+        snapshot = cls.__new__(cls)
+        snapshot.voice_channel_id, role_ids, game, snapshot.verdict = fields
+        snapshot.role_ids = frozenset(role_ids)
+        snapshot.game = tuple(game) if game is not None else None
+        snapshot.version = version
+        return snapshot
+
+
+class MemberStateCache(object):
+    def __init__(self):
+        self._members = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    def lookup(self, member, policies):
+        snapshot = MemberSnapshot(member)
+        previous = self._members.get(member.id)
+        if snapshot.voice_channel_id is None:
+            self._members.pop(member.id, None)
+            return snapshot
+        if previous is not None and previous.version == policies.version and previous.same_inputs(snapshot):
+            return previous
+        self._members[member.id] = snapshot
+        return snapshot
+
+    def discard(self, member_id):
+        self._members.pop(member_id, None)
+
+    def dump(self):
+        return {member_id: snapshot.dump() for member_id, snapshot in self._members.items()
+                if snapshot.verdict is not None}
+
+    def restore(self, members, version):
+        for member_id, fields in members.items():
+            self._members.setdefault(member_id, MemberSnapshot.restore(fields, version))
+
+
+class VerdictCache(object):
+    def __init__(self, max_size=4096):
+        self.version = None
+        self._cache = LRUCache(max_size=max_size)
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+    def key(self, policies, member_id, snapshot):
+        if member_id in policies.whitelisted_user_ids or snapshot.game is not None and snapshot.game[1] == 1:
+            return None
+        game = normalize_game_name(snapshot.game[0]) if snapshot.game is not None else None
+        return snapshot.voice_channel_id, game, snapshot.role_ids & policies.whitelisted_role_ids
+
+    def _check_version(self, policies):
+        if self.version != policies.version:
+            self._cache.clear()
+            self.version = policies.version
+
+    def get(self, policies, key):
+        if key is None:
+            return None
+        self._check_version(policies)
+        return self._cache.get(key)
+
+    def set(self, policies, key, verdict):
+        if key is None or verdict in STREAM_VERDICTS:
+            return
+        self._check_version(policies)
+        self._cache.set(key, verdict)
+
+
+class GuildState(object):
+    debounce_window = 0.5
+
+    def __init__(self, server_id, settings):
+        self.server_id = server_id
+        self.settings = settings
+        self.grace_checks = MemberTimers()
+        self.debounce = MemberTimers()
+        self.members = MemberStateCache()
+        self.verdicts = VerdictCache()
+        self.actions = ActionDispatcher(server_id)
+        self.streamers = {}
+
+    def dump(self):
+        return {
+            'settings': settings_digest(self.settings.settings),
+            'grace_checks': self.grace_checks.deadlines(),
+            'members': self.members.dump(),
+            'actions': self.actions.dump()
+        }
+
+    def restore(self, server, data):
+        # Verdicts are only reusable if they were reached under the settings in effect now.
+        if data['settings'] == settings_digest(self.settings.settings):
+            self.members.restore(data['members'], self.settings.policy.version)
+        now = time.time()
+        for member_id, deadline in data['grace_checks'].items():
+            self.grace_checks.schedule(member_id, max(0, deadline - now), check_member, server, member_id)
+        self.actions.restore(data['actions'])
+
+    async def close(self):
+        self.grace_checks.cancel_all()
+        self.debounce.cancel_all()
+        await self.actions.close()
+        await self.settings.close()
+
+
+class RuntimeState(object):
+    save_interval = 30
+    max_age = 600
+
+    def __init__(self, path=None):
+        self.path = path
+        self._restored = {}
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as state_file:
+                data = json.load(state_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Failed to load runtime state from {self.path}: {e!r}')
+            return
+        age = time.time() - data['time']
+        if age > self.max_age:
+            logger.info(f'Ignoring runtime state in {self.path}, it is {age:.0f}s old.')
+            return
+        self._restored = data['guilds']
+        logger.info(f'Loaded runtime state for {len(self._restored)} server(s) from {self.path} ({age:.0f}s old).')
+
+    def restore(self, server):
+        data = self._restored.pop(server.id, None)
+        if data is not None:
+            guilds.get(server).restore(server, data)
+
+    def forget_unclaimed(self):
+        # Saving these again would stamp them as fresh and keep them alive forever.
+        if self._restored:
+            logger.info(f'Dropping runtime state for {len(self._restored)} server(s) this bot is not connected to.')
+            self._restored = {}
+
+    def capture(self):
+        states = {state.server_id: state.dump() for state in guilds}
+        return json.dumps({'time': time.time(), 'guilds': states}, separators=(',', ':')).encode()
+
+    async def save(self):
+        if self.path is None:
+            return
+        data = self.capture()
+        await asyncio.get_event_loop().run_in_executor(None, atomic_write, self.path, data, '.bot_runtime.')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save()
+            except OSError as e:
+                logger.warning(f'Failed to save runtime state to {self.path}: {e!r}')
+
+
+def server_channels(server_id):
+    server = client.get_server(server_id)
+    return server.channels if server is not None else ()
+
+
+class GuildRegistry(object):
+    def __init__(self, settings_path=None, database=None):
+        if settings_path is None:
+            settings_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                         'bot_settings.pickle')
+        self.settings_path = settings_path
+        self.database = database
+        self._guilds = {}
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def __iter__(self):
+        return iter(list(self._guilds.values()))
+
+    def settings_path_for(self, server_id):
+        root, ext = os.path.splitext(self.settings_path)
+        return f'{root}.{server_id}{ext}'
+
+    def _store_for(self, server_id):
+        if self.database is not None:
+            return SQLiteSettingsStore(self.database, server_id)
+        return PickleSettingsStore(self.settings_path_for(server_id))
+
+    def _migrate_settings(self, server, settings):
+        if self.database is not None:
+            pickled = PickleSettingsStore(self.settings_path_for(server.id))
+            if pickled.exists():
+                logger.info(f'Migrating {pickled} to {settings.store} for {server.name}({server.id})')
+                settings.replace(pickled.load())
+                return
+        # Single server installs kept one settings file. Hand it to the server owning its admin role.
+        legacy = BotSettings(self.settings_path)
+        if not legacy.store.exists():
+            return
+        legacy.load()
+        if legacy.claimed and any(role.id == legacy.bot_admin_role_id for role in server.roles):
+            logger.info(f'Migrating {legacy.store} to {settings.store} for {server.name}({server.id})')
+            settings.replace(legacy.settings)
+
+    def get(self, server):
+        state = self._guilds.get(server.id)
+        if state is None:
+            settings = BotSettings(store=self._store_for(server.id))
+            settings.channel_source = functools.partial(server_channels, server.id)
+            exists = settings.store.exists()
+            settings.load()
+            if not exists:
+                self._migrate_settings(server, settings)
+            state = self._guilds[server.id] = GuildState(server.id, settings)
+        return state
+
+    async def reload(self, state, force=False):
+        started = time.monotonic()
+        reloaded = await state.settings.reload(force)
+        duration = time.monotonic() - started
+        if reloaded:
+            log_event(logging.INFO, 'settings_reloaded',
+                      'Reloaded settings for server {server_id} from {store} in {duration_ms:.1f}ms.',
+                      server_id=state.server_id, store=str(state.settings.store), duration_ms=duration * 1000)
+        return reloaded, duration
+
+    async def watch_settings(self, interval=5):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            for state in self:
+                settings = state.settings
+                try:
+                    if not await loop.run_in_executor(settings.store.executor, settings.changed_externally):
+                        continue
+                    digest = settings_digest(settings.settings)
+                    reloaded, _ = await self.reload(state)
+                except (OSError, sqlite3.Error, pickle.UnpicklingError, EOFError, ValueError) as e:
+                    logger.warning(f'Failed to reload settings from {settings.store}: {e!r}')
+                    continue
+                server = client.get_server(state.server_id)
+                if reloaded and server is not None and settings.enabled \
+                        and settings_digest(settings.settings) != digest:
+                    await sweep_restricted_channels(server)
+
+    async def discard(self, server):
+        state = self._guilds.pop(server.id, None)
+        if state is not None:
+            await state.close()
+
+    async def close(self):
+        for state in self:
+            await state.close()
+
+
+class Twitch(object):
+    api_url = 'https://api.twitch.tv/kraken'
+    request_timeout = 5
+    max_connections = 10
+    max_concurrent_requests = 4
+    game_cache_ttl = 60
+    batch_window = 0.25
+    batch_size = 100
+    requests_per_minute = 30
+
+    def __init__(self):
+        self._session = None
+        self._semaphore = None
+        self._pending = {}
+        self._flush_handle = None
+        self.user_ids = LRUCache(max_size=4096)
+        self.channel_games = TTLCache(max_size=1024, ttl=self.game_cache_ttl)
+        self.rate_limit = TokenBucket(rate=self.requests_per_minute / 60, capacity=self.requests_per_minute)
+
+    @property
+    def headers(self):
+        return {
             'Client-ID': TWITCH_CLIENT_ID,
             'Accept': 'application/vnd.twitchtv.v5+json'
         }
-        logger.debug(f'Twitch Name: {twitch_username}')
-        url = 'https://api.twitch.tv/kraken/users?login=' + twitch_username
-        resp = requests.get(url, headers=headers)
-        data = resp.json()
-        logger.debug(f'Twitch Get User JSON: {data}')
-        url = 'https://api.twitch.tv/kraken/channels/' + data['users'][0]['_id']
-        resp = requests.get(url, headers=headers)
-        data = resp.json()
-        logger.debug(f'Twitch Get Channel JSON: {data}')
-        if data['game'] in settings.restricted_voice_channels[voice_channel_id]:
-            logger.debug(f'Twitch User ({twitch_username}) validated '
-                         f'voice channel ({voice_channel_id}) with {data["game"]}.')
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self._session
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self._semaphore
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _update_rate_limit(self, resp):
+        limit = resp.headers.get('Ratelimit-Limit')
+        remaining = resp.headers.get('Ratelimit-Remaining')
+        reset = resp.headers.get('Ratelimit-Reset')
+        if limit is not None:
+            self.rate_limit.capacity = int(limit)
+            self.rate_limit.rate = int(limit) / 60
+        if remaining is not None:
+            self.rate_limit.tokens = min(self.rate_limit.tokens, int(remaining))
+            if int(remaining) == 0 and reset is not None:
+                self.rate_limit.block_for(max(0, int(reset) - time.time()))
+
+    async def _fetch_json(self, url, params=None):
+        async with self.session.get(url, params=params) as resp:
+            self._update_rate_limit(resp)
+            if resp.status == 429:
+                self.rate_limit.block_for(int(resp.headers.get('Retry-After', 60)))
+            if resp.status != 200:
+                raise TwitchAPIError(f'{url} returned HTTP {resp.status}')
+            return await resp.json()
+
+    async def get_json(self, path, params=None):
+        await self.rate_limit.acquire()
+        async with self.semaphore:
+            twitch_requests_total.inc(endpoint=path)
+            with twitch_request_seconds.time(endpoint=path):
+                return await asyncio.wait_for(self._fetch_json(self.api_url + path, params),
+                                              self.request_timeout)
+
+    @property
+    def cache_stats(self):
+        return {'user_ids': self.user_ids.stats, 'channel_games': self.channel_games.stats}
+
+    def _chunks(self, items):
+        items = list(items)
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    async def _resolve_user_ids(self, twitch_usernames):
+        for chunk in self._chunks(twitch_usernames):
+            data = await self.get_json('/users', params={'login': ','.join(chunk)})
+            logger.debug('Twitch Get Users JSON: %s', data)
+            for user in data['users']:
+                self.user_ids.set(user['name'].lower(), user['_id'])
+
+    async def _resolve_stream_games(self, user_ids):
+        for chunk in self._chunks(user_ids):
+            data = await self.get_json('/streams', params={'channel': ','.join(chunk), 'limit': len(chunk)})
+            logger.debug('Twitch Get Streams JSON: %s', data)
+            live = {str(stream['channel']['_id']): stream['game'] for stream in data['streams']}
+            for user_id in chunk:
+                self.channel_games.set(user_id, live.get(user_id))
+
+    async def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        error = None
+        try:
+            await self._resolve_user_ids(login for login in pending if self.user_ids.peek(login) is None)
+            user_ids = {login: self.user_ids.peek(login) for login in pending}
+            await self._resolve_stream_games(user_id for user_id in set(user_ids.values())
+                                             if user_id is not None and user_id not in self.channel_games)
+            for login, futures in pending.items():
+                user_id = user_ids[login]
+                game = self.channel_games.peek(user_id) if user_id is not None else None
+                for future in futures:
+                    if not future.done():
+                        future.set_result(game)
+        except Exception as e:
+            logger.warning(f'Twitch API batch request failed for {len(pending)} user(s): {e!r}')
+            error = e
+        finally:
+            # A failed lookup is not the same as an offline stream; never leave a waiting check hanging.
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(TwitchAPIError(f'Twitch lookup failed: {error!r}'))
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.batch_window, lambda: asyncio.ensure_future(self._flush()))
+
+    async def get_stream_game(self, twitch_username):
+        user_id = self.user_ids.get(twitch_username)
+        if user_id is not None:
+            game = self.channel_games.get(user_id, LRUCache._missing)
+            if game is not LRUCache._missing:
+                return game
+        future = asyncio.get_event_loop().create_future()
+        self._pending.setdefault(twitch_username, []).append(future)
+        if len(self._pending) >= self.batch_size:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            asyncio.ensure_future(self._flush())
+        else:
+            self._schedule_flush()
+        return await future
+
+    async def refresh_stream_games(self, twitch_usernames):
+        for twitch_username in twitch_usernames:
+            user_id = self.user_ids.peek(twitch_username)
+            if user_id is not None:
+                self.channel_games.pop(user_id)
+        games = await asyncio.gather(*[self.get_stream_game(twitch_username) for twitch_username in twitch_usernames],
+                                     return_exceptions=True)
+        # Report only the streams Twitch actually answered for.
+        return {twitch_username: game for twitch_username, game in zip(twitch_usernames, games)
+                if not isinstance(game, Exception)}
+
+    async def validate_twitch_game(self, twitch_username, policy):
+        twitch_username = twitch_username.strip('/').lower()
+        logger.debug('Twitch Name: %s', twitch_username)
+        try:
+            game = await self.get_stream_game(twitch_username)
+        except TwitchAPIError as e:
+            twitch_validations_total.inc(result='unknown')
+            log_event(logging.DEBUG, 'twitch_unknown',
+                      'Twitch User ({twitch_username}) could not be validated for voice channel ({channel_id}): '
+                      '{error}',
+                      twitch_username=twitch_username, channel_id=policy.channel_id, error=e)
+            return None
+        if game is not None and policy.allows(game):
+            log_event(logging.DEBUG, 'twitch_validated',
+                      'Twitch User ({twitch_username}) validated voice channel ({channel_id}) with {game}.',
+                      twitch_username=twitch_username, channel_id=policy.channel_id, game=game)
+            twitch_validations_total.inc(result='valid')
             return True
-        logger.debug(f'Twitch User ({twitch_username}) unable to validate '
-                     f'voice channel ({voice_channel_id}) with {data["game"]}.')
+        twitch_validations_total.inc(result='invalid')
+        log_event(logging.DEBUG, 'twitch_rejected',
+                  'Twitch User ({twitch_username}) unable to validate voice channel ({channel_id}) with {game}.',
+                  twitch_username=twitch_username, channel_id=policy.channel_id, game=game)
         return False
 
 
 twitch = Twitch()
-settings = BotSettings()
+guilds = GuildRegistry()
+audit_log = AuditLog()
+runtime = RuntimeState()
+metrics.gauge('voice_bot_guilds', 'Servers with loaded state.', lambda: len(guilds))
+metrics.gauge('voice_bot_pending_grace_checks', 'Pending game-close grace period checks.',
+              lambda: sum(len(state.grace_checks) for state in guilds))
+metrics.gauge('voice_bot_tracked_streams', 'Twitch-validated members awaiting periodic re-validation.',
+              lambda: sum(len(state.streamers) for state in guilds))
+metrics.gauge('voice_bot_queued_actions', 'Discord actions waiting in dispatch queues.',
+              lambda: sum(len(state.actions) for state in guilds))
+
+
+def guild_settings(ctx):
+    if ctx.message.server is None:
+        return None
+    return guilds.get(ctx.message.server).settings
+
+
+ALLOWED = 'allowed'
+WHITELISTED = 'whitelisted'
+STREAM_VALIDATED = 'stream_validated'
+STREAM_UNVERIFIED = 'stream_unverified'
+STREAM_VERDICTS = (STREAM_VALIDATED, STREAM_UNVERIFIED)
+DENIED = 'denied'
+STREAM_CHECK = 'stream_check'
+TWITCH_URL = 'https://www.twitch.tv/'
+
+
+def twitch_login(game):
+    if game is None or game.type != 1 or not (game.url or '').startswith(TWITCH_URL):
+        return None
+    return game.url[len(TWITCH_URL):].strip('/').lower()
+
 
+def decide_facts(policies, member_id, voice_channel_id, role_ids, game):
+    if member_id in policies.whitelisted_user_ids or not role_ids.isdisjoint(policies.whitelisted_role_ids):
+        return WHITELISTED
+    policy = policies.channels.get(voice_channel_id)
+    if policy is None or (game is not None and policy.allows(game[0])):
+        return ALLOWED
+    if game is not None and game[1] == 1 and (game[2] or '').startswith(TWITCH_URL):
+        return STREAM_CHECK
+    return DENIED
 
+
+_worker_policies = {}
+
+
+def decide_batch(server_id, version, blob, facts):
+    policies = _worker_policies.get(server_id)
+    if policies is None or policies.version != version:
+        if blob is None:
+            return None
+        policies = _worker_policies[server_id] = pickle.loads(blob)
+    return [decide_facts(policies, *member) for member in facts]
+
+
+class DecisionPool(object):
+    batch_window = 0.005
+    batch_size = 256
+
+    def __init__(self):
+        self.executor = None
+        self._blobs = {}
+        self._pending = {}
+        self._flush_handle = None
+
+    @property
+    def enabled(self):
+        return self.executor is not None
+
+    def start(self, workers):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        logger.info(f'Deciding restriction checks in {workers} worker process(es).')
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, batch in self._pending.values():
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        self._pending = {}
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _blob(self, server_id, settings):
+        version, blob = self._blobs.get(server_id, (None, None))
+        if version != settings.version:
+            blob = pickle.dumps(settings.policy)
+            self._blobs[server_id] = settings.version, blob
+        return blob
+
+    async def _submit(self, server_id, version, blob, facts):
+        loop = asyncio.get_event_loop()
+        verdicts = await loop.run_in_executor(self.executor, decide_batch, server_id, version, None, facts)
+        if verdicts is None:
+            worker_decisions_total.inc(result='policy_miss')
+            verdicts = await loop.run_in_executor(self.executor, decide_batch, server_id, version, blob, facts)
+        return verdicts
+
+    async def _decide_batch(self, server_id, version, blob, batch):
+        try:
+            verdicts = await self._submit(server_id, version, blob, [facts for facts, _ in batch])
+        except Exception as e:
+            logger.warning(f'Decision worker failed for {len(batch)} member(s), deciding locally: {e!r}')
+            worker_decisions_total.inc(len(batch), result='failed')
+            verdicts = [None] * len(batch)
+        else:
+            worker_decisions_total.inc(len(batch), result='decided')
+        for (_, future), verdict in zip(batch, verdicts):
+            if not future.done():
+                future.set_result(verdict)
+
+    async def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(*[self._decide_batch(server_id, version, blob, batch)
+                               for (server_id, version), (blob, batch) in pending.items()])
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.batch_window, lambda: asyncio.ensure_future(self._flush()))
+
+    async def decide(self, state, policies, member_id, snapshot):
+        key = state.server_id, policies.version
+        if key not in self._pending:
+            self._pending[key] = (self._blob(state.server_id, state.settings), [])
+        batch = self._pending[key][1]
+        future = asyncio.get_event_loop().create_future()
+        batch.append(((member_id, snapshot.voice_channel_id, snapshot.role_ids, snapshot.game), future))
+        if len(batch) >= self.batch_size:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            asyncio.ensure_future(self._flush())
+        else:
+            self._schedule_flush()
+        return await future
+
+
+decisions = DecisionPool()
+
+
+async def decide_verdict(policies, member, username):
+    if member.id in policies.whitelisted_user_ids:
+        log_event(logging.DEBUG, 'whitelisted_user', '{username}({member_id}) is a WHITELISTED USER. Ignoring.',
+                  username=username, member_id=member.id)
+        return WHITELISTED
+    role = policies.whitelisted_role(member)
+    if role is not None:
+        log_event(logging.DEBUG, 'whitelisted_role',
+                  '{username}({member_id}) is WHITELISTED via {role_name}({role_id}). Ignoring.',
+                  username=username, member_id=member.id, role_name=role.name, role_id=role.id)
+        return WHITELISTED
+    policy = policies.channel_policy(member)
+    if policy is None or (member.game is not None and policy.allows(member.game.name)):
+        return ALLOWED
+    twitch_username = twitch_login(member.game)
+    if twitch_username is not None:
+        log_event(logging.DEBUG, 'twitch_validating', '{username}({member_id}) is streaming. Validating via Twitch...',
+                  username=username, member_id=member.id)
+        validated = await twitch.validate_twitch_game(twitch_username, policy)
+        if validated:
+            log_event(logging.DEBUG, 'twitch_passed', '{username}({member_id}) validated via Twitch! Ignoring.',
+                      username=username, member_id=member.id)
+            return STREAM_VALIDATED
+        if validated is None:
+            log_event(logging.INFO, 'twitch_unavailable',
+                      '{username}({member_id}) could not be validated, Twitch is unavailable. '
+                      'Leaving them until the next stream check.', username=username, member_id=member.id)
+            return STREAM_UNVERIFIED
+    return DENIED
+
+
+def enforce_verdict(state, policies, member, verdict, username):
+    if verdict == STREAM_UNVERIFIED:
+        return False
+    if verdict != DENIED:
+        if not policies.kick_mode and member.voice.mute:
+            return state.actions.mute(member, False)
+        return False
+    policy = policies.channel_policy(member)
+    game_channel = member.voice.voice_channel
+    log_event(logging.INFO, 'check_failed',
+              '{username}({member_id}) has failed the check for {channel_name}({channel_id}). '
+              'Acceptable Games: {games}', username=username, member_id=member.id,
+              channel_name=game_channel.name, channel_id=game_channel.id, games=policy.games_display)
+    if policy.kick_mode:
+        log_event(logging.INFO, 'move', 'Moving {username}({member_id}) {channel_name}({channel_id}) -> ({target_id})',
+                  username=username, member_id=member.id, channel_name=game_channel.name,
+                  channel_id=game_channel.id, target_id=policy.target_channel_id)
+        queued = state.actions.move(member, policy.target_channel_id)
+    else:
+        log_event(logging.INFO, 'mute', 'Muting {username}({member_id}) {channel_name}({channel_id})',
+                  username=username, member_id=member.id, channel_name=game_channel.name, channel_id=game_channel.id)
+        if member.voice.mute:
+            log_event(logging.INFO, 'already_muted', '{username}({member_id}) is already server muted. Ignoring.',
+                      username=username, member_id=member.id)
+            return False
+        queued = state.actions.mute(member)
+    if queued and policy.notify_channel_id:
+        state.actions.notify(policy, member, game_channel.name)
+    return queued
+
+
+@timed(check_seconds)
 async def can_join_restricted_voice_channel(member):
-    if not settings.enabled:
+    state = guilds.get(member.server)
+    policies = state.settings.policy
+    if not policies.enabled:
         logger.debug('Bot is disabled. Ignoring.')
-        return
+        return False
     username = member.nick if member.nick is not None else member.name
-    if member.id in settings.whitelisted_user_ids:
-        logger.debug(f'{username}({member.id}) is a WHITELISTED USER. Ignoring.')
-        if not settings.kick_mode and member.voice.mute:
-            await client.server_voice_state(member, mute=False)
-        return
-    for role in member.roles:
-        if role.id in settings.whitelisted_role_ids:
-            logger.debug(f'{username}({member.id}) is WHITELISTED via {role.name}({role.id}). Ignoring.')
-            if not settings.kick_mode and member.voice.mute:
-                await client.server_voice_state(member, mute=False)
-            return
-    if member.voice is not None and member.voice.voice_channel is not None\
-            and member.voice.voice_channel.id in settings.restricted_voice_channels and\
-            (member.game is None or
-             member.game.name not in settings.restricted_voice_channels[member.voice.voice_channel.id]):
-        if member.game is not None and member.game.type == 1 and member.game.url.startswith('https://www.twitch.tv/'):
-            logger.debug(f'{username}({member.id}) is streaming. Validating via Twitch...')
-            twitch_username = member.game.url.replace('https://www.twitch.tv/', '')
-            if twitch.validate_twitch_game(twitch_username, member.voice.voice_channel.id):
-                logger.debug(f'{username}({member.id}) validated via Twitch! Ignoring.')
-                return
-        game_channel_name = member.voice.voice_channel.name
-        general_channel = client.get_channel(settings.general_voice_channel_id)
-        games = ",".join(settings.restricted_voice_channels[member.voice.voice_channel.id])
-        logger.info(f'{username}({member.id}) has failed the check for '
-                    f'{member.voice.voice_channel.name}({member.voice.voice_channel.id}). '
-                    f'Acceptable Games: {games}')
-        if settings.kick_mode:
-            logger.info(f'Moving {username}({member.id}) '
-                        f'{member.voice.voice_channel.name}({member.voice.voice_channel.id}) -> '
-                        f'{general_channel.name}({general_channel.id})')
-            await client.move_member(member, general_channel)
-            if settings.bot_text_channel_id:
-                await client.send_message(client.get_channel(settings.bot_text_channel_id),
-                                          f'{member.mention} You must be playing the following to join '
-                                          f'{game_channel_name}: {games}. If you are streaming, '
-                                          f'I am only friends with Twitch for right now and am unable '
-                                          f'to determine what game you are currently playing outside of '
-                                          f'my friends list. :( ')
-            return
-        else:
-            logger.info(f'Muting {username}({member.id}) '
-                        f'{member.voice.voice_channel.name}({member.voice.voice_channel.id})')
-            if member.voice.mute:
-                logger.info(f'{username}({member.id}) is already server muted. Ignoring.')
-                return
-            await client.server_voice_state(member, mute=True)
-            logger.info(f'Muted {username}({member.id}) in {game_channel_name}.')
-            if settings.bot_text_channel_id:
-                await client.send_message(client.get_channel(settings.bot_text_channel_id),
-                                          f'{member.mention} You must be playing the following to not be '
-                                          f'muted in {game_channel_name}: {games}. If you are streaming, '
-                                          f'I am only friends with Twitch for right now and am unable '
-                                          f'to determine what game you are currently playing outside of '
-                                          f'my friends list. :( ')
-            return
-    else:
-        if not settings.kick_mode and member.voice.mute:
-            await client.server_voice_state(member, mute=False)
+    snapshot = state.members.lookup(member, policies)
+    verdict = snapshot.verdict
+    if verdict is None:
+        key = state.verdicts.key(policies, member.id, snapshot)
+        verdict = state.verdicts.get(policies, key)
+        if verdict is None:
+            if decisions.enabled:
+                verdict = await decisions.decide(state, policies, member.id, snapshot)
+            if verdict is None or verdict == STREAM_CHECK:
+                verdict = await decide_verdict(policies, member, username)
+            state.verdicts.set(policies, key, verdict)
+        if verdict not in STREAM_VERDICTS:
+            snapshot.remember(verdict, policies)
+    if verdict in STREAM_VERDICTS:
+        state.streamers[member.id] = snapshot.voice_channel_id, twitch_login(member.game)
+    elif state.streamers:
+        state.streamers.pop(member.id, None)
+    return enforce_verdict(state, policies, member, verdict, username)
+
+
+class SweepResult(object):
+    __slots__ = ('members', 'queued', 'duration')
+
+    def __init__(self, members, queued, duration):
+        self.members = members
+        self.queued = queued
+        self.duration = duration
+
+    def __str__(self):
+        return (f'Checked {self.members} member(s) in {self.duration:.2f}s, '
+                f'queued {self.queued} action(s).')
+
+
+async def sweep_restricted_channels(server, channel_ids=None, concurrency=10):
+    started = time.monotonic()
+    state = guilds.get(server)
+    if channel_ids is None:
+        channel_ids = list(state.settings.policy.channels)
+    members = iter([member for channel in map(server.get_channel, channel_ids) if channel is not None
+                    for member in channel.voice_members])
+    checked = 0
+
+    async def worker():
+        nonlocal checked
+        queued = 0
+        for member in members:
+            # Members who just quit their game are left to their grace period.
+            if member.id in state.grace_checks:
+                continue
+            checked += 1
+            if await can_join_restricted_voice_channel(member):
+                queued += 1
+        return queued
+
+    queued = sum(await asyncio.gather(*[worker() for _ in range(concurrency)]))
+    result = SweepResult(checked, queued, time.monotonic() - started)
+    logger.info(f'Swept restricted channels on {server.name}({server.id}): {result}')
+    return result
+
+
+async def revalidate_streams(interval=120):
+    while True:
+        await asyncio.sleep(interval)
+        streams = [(state, member_id, channel_id, twitch_username) for state in guilds
+                   for member_id, (channel_id, twitch_username) in list(state.streamers.items())]
+        if not streams:
+            continue
+        games = await twitch.refresh_stream_games(list({twitch_username for _, _, _, twitch_username in streams}))
+        changed = 0
+        for state, member_id, channel_id, twitch_username in streams:
+            server = client.get_server(state.server_id)
+            member = server.get_member(member_id) if server is not None else None
+            policy = state.settings.policy.channels.get(channel_id)
+            if member is None or policy is None or voice_channel_id(member) != channel_id \
+                    or twitch_login(member.game) != twitch_username:
+                if state.streamers.get(member_id) == (channel_id, twitch_username):
+                    del state.streamers[member_id]
+                continue
+            if twitch_username not in games:
+                stream_revalidations_total.inc(result='unknown')
+                continue
+            if games[twitch_username] is not None and policy.allows(games[twitch_username]):
+                stream_revalidations_total.inc(result='unchanged')
+                continue
+            stream_revalidations_total.inc(result='changed')
+            changed += 1
+            await can_join_restricted_voice_channel(member)
+        log_event(logging.INFO, 'streams_revalidated',
+                  'Re-validated {streams} Twitch stream(s), {changed} no longer match their channel.',
+                  streams=len(streams), changed=changed)
+
+
+def announce_claim_code(server, settings):
+    if settings.claimed:
+        return
+    if settings.claim_code is None:
+        settings.claim_code = str(uuid4())
+    logger.warning(f'THIS BOT IS UNCLAIMED ON {server.name}({server.id})')
+    logger.warning(f'To claim this bot run this command:\n\n'
+                   f'!voice_bot claim {settings.claim_code} @bot_admin_role')
+
+
+@client.event
+async def on_ready():
+    logger.info(f'Connected to {len(client.servers)} server(s).')
+    for server in client.servers:
+        settings = guilds.get(server).settings
+        announce_claim_code(server, settings)
+        runtime.restore(server)
+        if settings.enabled:
+            await sweep_restricted_channels(server)
+    runtime.forget_unclaimed()
+
+
+@client.event
+async def on_server_join(server):
+    logger.info(f'Joined {server.name}({server.id}).')
+    announce_claim_code(server, guilds.get(server).settings)
 
 
 @client.event
-async def on_voice_state_update(_, after):
-    await can_join_restricted_voice_channel(after)
+async def on_member_remove(member):
+    state = guilds.get(member.server)
+    state.members.discard(member.id)
+    state.streamers.pop(member.id, None)
+
+
+@client.event
+async def on_server_remove(server):
+    logger.info(f'Removed from {server.name}({server.id}).')
+    await guilds.discard(server)
+
+
+async def reindex_channel(channel):
+    if getattr(channel, 'is_private', False) or channel.server is None:
+        return
+    settings = guilds.get(channel.server).settings
+    if settings.index_channel(channel) and settings.enabled:
+        await sweep_restricted_channels(channel.server, [channel.id])
+
+
+@client.event
+async def on_channel_create(channel):
+    await reindex_channel(channel)
+
+
+@client.event
+async def on_channel_update(before, after):
+    await reindex_channel(after)
+
+
+@client.event
+async def on_channel_delete(channel):
+    if getattr(channel, 'is_private', False) or channel.server is None:
+        return
+    guilds.get(channel.server).settings.unindex_channel(channel.id)
+
+
+async def check_member(server, member_id):
+    member = server.get_member(member_id)
+    if member is None:
+        return False
+    # A firing grace timer is removed before it calls us, so this only holds back other checks.
+    if member_id in guilds.get(server).grace_checks:
+        events_total.inc(stage='deferred')
+        return False
+    events_total.inc(stage='evaluated')
+    return await can_join_restricted_voice_channel(member)
+
+
+async def debounce_check(state, member):
+    if state.debounce_window <= 0:
+        await check_member(member.server, member.id)
+    elif not state.debounce.schedule(member.id, state.debounce_window, check_member, member.server, member.id):
+        events_total.inc(stage='debounced')
+
+
+def voice_channel_id(member):
+    if member.voice is None or member.voice.voice_channel is None:
+        return None
+    return member.voice.voice_channel.id
+
+
+def game_key(member):
+    if member.game is None:
+        return None
+    return member.game.name, member.game.type, member.game.url
+
+
+def voice_state_changed(before, after):
+    return voice_channel_id(before) != voice_channel_id(after) or before.voice.mute != after.voice.mute
+
+
+def member_changed(before, after):
+    return voice_channel_id(before) != voice_channel_id(after) or game_key(before) != game_key(after) \
+        or before.roles != after.roles
+
+
+@client.event
+async def on_voice_state_update(before, after):
+    events_total.inc(stage='received')
+    if not voice_state_changed(before, after):
+        events_total.inc(stage='filtered')
+        return
+    state = guilds.get(after.server)
+    if after.id in state.grace_checks:
+        if voice_channel_id(before) == voice_channel_id(after):
+            return
+        state.grace_checks.cancel(after.id)
+    await debounce_check(state, after)
 
 
 @client.event
 async def on_member_update(before, after):
-    if before.voice is not None and after.voice is not None \
-        and before.voice.voice_channel is not None and after.voice.voice_channel is not None \
-            and after.voice.voice_channel.id in settings.restricted_voice_channels \
-            and before.game is not None \
-            and before.game.name in settings.restricted_voice_channels[before.voice.voice_channel.id] \
-            and after.game is None and before.voice.voice_channel.id == after.voice_channel.id:
-        username = before.nick if before.nick is not None else before.name
-        logger.debug(f'{username}({before.id}) appears to have quit game. '
-                     f'Sleeping for {settings.game_close_disconnect_timeout}s before validating...')
-        await asyncio.sleep(settings.game_close_disconnect_timeout)
-        after = list(client.servers)[0].get_member(after.id)
-    await can_join_restricted_voice_channel(after)
+    events_total.inc(stage='received')
+    if not member_changed(before, after):
+        events_total.inc(stage='filtered')
+        return
+    state = guilds.get(after.server)
+    settings, grace_checks = state.settings, state.grace_checks
+    if after.id in grace_checks:
+        if after.game is None and voice_channel_id(before) == voice_channel_id(after):
+            return
+        grace_checks.cancel(after.id)
+        logger.debug('Cancelled pending grace period check for %s.', after.id)
+    policy = settings.policy.channel_policy(before)
+    if policy is not None and voice_channel_id(before) == voice_channel_id(after) \
+            and before.game is not None and policy.allows(before.game.name) and after.game is None:
+        if state.debounce.cancel(after.id):
+            logger.debug('Cancelled pending check for %s in favour of the grace period.', after.id)
+        if grace_checks.schedule(after.id, settings.game_close_disconnect_timeout,
+                                 check_member, after.server, after.id):
+            log_event(logging.DEBUG, 'grace_period_started',
+                      '{username}({member_id}) appears to have quit game. Waiting {timeout}s before validating...',
+                      username=before.nick if before.nick is not None else before.name, member_id=before.id,
+                      timeout=settings.game_close_disconnect_timeout)
+        return
+    await debounce_check(state, after)
 
 
 @client.group(pass_context=True)
 async def voice_bot(ctx):
     if ctx.invoked_subcommand is None:
-        if not settings.authorize_command(ctx.message.author):
+        settings = guild_settings(ctx)
+        if settings is None or not settings.authorize_command(ctx.message.author):
             return
         message = ctx.message.content.replace('!voice_bot ', '')
         if message.lower() == 'enable':
             if settings.general_voice_channel_id and settings.set_enabled():
                 await client.say('Restrictions Enabled!')
+                await client.say(str(await sweep_restricted_channels(ctx.message.server)))
             else:
                 await client.say('general_voice_channel_id not set or an error occurred!')
         elif message.lower() == 'disable':
@@ -372,7 +2434,15 @@ async def voice_bot(ctx):
                              'different than Discord.\n'
                              '!voice_bot release <voice_channel_id>                                 Releases a '
                              'voice channel from all restrictions.\n'
-                             '!voice_bot status                                                     Get a status '
+                             '!voice_bot alias add|remove <"alias"> <"game">                        Treat an '
+                             'alternate game name as the given game in every restriction.\n'
+                             '!voice_bot reload                                                     Reload the '
+                             'settings file after editing it outside the bot.\n'
+                             '!voice_bot export json|yaml                                           Export the '
+                             'settings as a policy file.\n'
+                             '!voice_bot import                                                     Apply an attached '
+                             'policy file in one step.\n'
+                             '!voice_bot status [page]                                              Get a status '
                              'report.'
                              '```\n\n'
                              'To restrict voice channel ID 1234 to ARK and ATLAS, we specify both Discord and Twitch '
@@ -383,9 +2453,10 @@ async def voice_bot(ctx):
                              '```')
 
 
-@voice_bot.command(name='claim')
-async def _claim(code, role=None):
-    if settings.claimed:
+@voice_bot.command(name='claim', pass_context=True)
+async def _claim(ctx, code, role=None):
+    settings = guild_settings(ctx)
+    if settings is None or settings.claimed:
         return False
     if code.lower() == 'help':
         await client.say('Claim the Voice Bot with claim code and attach '
@@ -408,7 +2479,8 @@ async def _claim(code, role=None):
 async def _set(ctx, setting, arg):
     settable_props = ['general_voice_channel_id', 'bot_text_channel_id',
                       'game_close_disconnect_timeout', 'bot_admin_role_id']
-    if not settings.authorize_command(ctx.message.author):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
         return
     if setting in settable_props:
         if setting == 'bot_text_channel_id' and arg.lower() == 'none':
@@ -428,7 +2500,8 @@ async def _set(ctx, setting, arg):
 
 @voice_bot.command(name='kick', pass_context=True)
 async def _kick(ctx, state):
-    if not settings.authorize_command(ctx.message.author):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
         return
     if state.lower() == 'help':
         await client.say('Enabled or disables Voice Channel Kick. If disabled, '
@@ -447,17 +2520,17 @@ async def _kick(ctx, state):
 
 @voice_bot.command(name='whitelist', pass_context=True)
 async def _whitelist(ctx, mode, *args):
-    if not settings.authorize_command(ctx.message.author):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
         return
     if mode.lower() == 'add':
         remove = False
     elif mode.lower() == 'remove':
         remove = True
     elif mode.lower() == 'list':
-        users = '\n'.join([f'<@{user}>' for user in settings.whitelisted_user_ids])
-        roles = '\n'.join([f'<@&{role}>' for role in settings.whitelisted_role_ids])
-        message = f'**Whitelist**\n**Users:**\n{users}\n\n**Roles**:\n{roles}'
-        await client.say(message)
+        lines = itertools.chain(['**Users:**'], (f'<@{user}>' for user in settings.whitelisted_user_ids),
+                                ['', '**Roles**:'], (f'<@&{role}>' for role in settings.whitelisted_role_ids))
+        await say_page('Whitelist', lines, page_number(args), '!voice_bot whitelist list', code=False)
         return
     elif mode.lower() == 'help':
         await client.say('Add user(s) or role(s) to the whitelist.\n\n'
@@ -469,130 +2542,376 @@ async def _whitelist(ctx, mode, *args):
         return
     if not args:
         await client.say('Must @ Role(s) or User(s)')
+    roles = {role.id: role for role in ctx.message.server.roles}
+    resolved = []
     for object_id in args:
         obj = re.findall(r'<@(\d+)>', object_id)
-        if not obj:
-            obj = re.findall(r'<@&(\d+)>', object_id)
-            if not obj:
-                print(object_id)
-                await client.say(f'Invalid ID: {object_id}')
-                continue
+        if obj:
+            member = ctx.message.server.get_member(obj[0])
+            if member is None:
+                resolved.append((f'{object_id} is not a member of this server! Ignoring!', None, None))
             else:
-                for role in list(client.servers)[0].roles:
-                    print((role.id, role.name))
-                    if role.id == obj[0]:
-                        settings.whitelist_role(role.id, remove)
-                        if remove:
-                            await client.say(f'Removed {role.mention} from Whitelist')
-                        else:
-                            await client.say(f'Whitelisted {role.mention}')
-                        break
-                else:
-                    await client.say(f'ID {obj} not User or Role! Ignoring!')
-                    continue
+                resolved.append((None, settings.whitelist_user, member))
+            continue
+        obj = re.findall(r'<@&(\d+)>', object_id)
+        if not obj:
+            resolved.append((f'Invalid ID: {object_id}', None, None))
+        elif obj[0] not in roles:
+            resolved.append((f'ID {obj} not User or Role! Ignoring!', None, None))
         else:
-            member = list(client.servers)[0].get_member(obj[0])
-            settings.whitelist_user(member.id, remove)
-            if remove:
-                await client.say(f'Removed {member.mention} from Whitelist')
-            else:
-                await client.say(f'Whitelisted {member.mention}')
+            resolved.append((None, settings.whitelist_role, roles[obj[0]]))
+    with settings.transaction():
+        for _, whitelist, target in resolved:
+            if whitelist is not None:
+                whitelist(target.id, remove)
+    for error, _, target in resolved:
+        if error is not None:
+            await client.say(error)
+        elif remove:
+            await client.say(f'Removed {target.mention} from Whitelist')
+        else:
+            await client.say(f'Whitelisted {target.mention}')
+
+
+def restriction_lines(server, settings):
+    names = {channel.id: channel.name for channel in server.channels}
+    for channel_id, games in settings.restricted_voice_channels.items():
+        yield f'{names.get(channel_id)} ({channel_id}) -- {", ".join(games)}'
+    for pattern, games in settings.restricted_channel_patterns.items():
+        yield f'Pattern {pattern} -- {", ".join(games)}'
+    matched = len(settings.policy.channels) - len(settings.policy.explicit_channel_ids)
+    if matched:
+        yield f'({matched} channel(s) matched by patterns)'
+
+
+def paginate(lines, budget):
+    page, size = [], 0
+    for line in lines:
+        if len(line) > budget:
+            line = line[:budget - 3] + '...'
+        if page and size + len(line) + 1 > budget:
+            yield page
+            page, size = [], 0
+        page.append(line)
+        size += len(line) + 1
+    if page:
+        yield page
+
+
+def page_number(args):
+    return int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 1
+
+
+async def say_page(title, lines, page=1, command=None, code=True):
+    fence = '```' if code else ''
+    footer = f'\nPage {page}, more with `{command} {page + 1}`' if command is not None else ''
+    budget = ActionDispatcher.max_message_length - len(f'**{title}**\n{fence}\n{fence}') - len(footer) - 10
+    pages = paginate(lines, budget)
+    current = next(itertools.islice(pages, page - 1, None), None)
+    if current is None:
+        await client.say(f'**{title}**\nNothing to show.' if page == 1 else f'**{title}**\nThere is no page {page}.')
+        return
+    more = command is not None and next(pages, None) is not None
+    body = '\n'.join(current)
+    await client.say(f'**{title}**\n{fence}{body}{fence}' + (footer if more else ''))
 
 
 @voice_bot.command(name='restrict', pass_context=True)
 async def _restrict(ctx, channel, *args):
-    if not settings.authorize_command(ctx.message.author):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
         return
     if channel.lower() == 'help':
-        await client.say('Add a voice channel to the restricted list.\n\n'
+        await client.say('Add a voice channel, or every voice channel whose name matches a pattern, '
+                         'to the restricted list.\n\n'
                          '!voice_bot restrict numeric_voice_channel_id '
-                         'game game "game with spaces"')
+                         'game game "game with spaces"\n'
+                         '!voice_bot restrict pattern "lobby-*" game "game with spaces"')
+        return
     if channel.lower() == 'list':
-        message = f'**Restricted Channels**\n\n'
-        for channel, games in settings.restricted_voice_channels.items():
-            channel = client.get_channel(channel)
-            games = ', '.join(games)
-            message += f'{channel}: {games}'
-        await client.say(message)
+        await say_page('Restricted Channels', restriction_lines(ctx.message.server, settings), page_number(args),
+                       '!voice_bot restrict list')
         return
+    if channel.lower() == 'category':
+        # discord.py 0.16 does not expose channel categories, so a category restriction could never match.
+        await client.say('Category restrictions are not supported. '
+                         'Restrict the channels individually or with a name pattern instead.')
+        return
+    kind = 'pattern' if channel.lower() == 'pattern' else 'channel'
+    if kind != 'channel':
+        if not args:
+            await client.say(f'You must provide a {kind} to restrict.')
+            return
+        channel, args = args[0], args[1:]
     if not args:
         await client.say('You must provide a list of games to restrict the channel to.')
         return
-    channel = client.get_channel(channel)
+    if kind == 'channel':
+        channel_id, channel = channel, ctx.message.server.get_channel(channel)
+        if channel is None or not is_voice_channel(channel):
+            await client.say(f'No voice channel {channel_id} on this server.')
+            return
+        target = channel.name
+    else:
+        target = f'every voice channel named like {channel}'
     games = ', '.join(args)
-    await client.say(f'Are you sure you want to restrict {channel.name} '
+    await client.say(f'Are you sure you want to restrict {target} '
                      f'to people playing {games}?\n\n 1. Yes    2. No')
     response = await client.wait_for_message(author=ctx.message.author, timeout=30)
     if response is None or response.content != '1':
         await client.say('Aborted')
         return
-    settings.restrict_channel(channel.id, args)
+    channel_ids = None
+    if kind == 'channel':
+        settings.restrict_channel(channel.id, args)
+        channel_ids = [channel.id]
+    else:
+        settings.restrict_pattern(channel, args)
     await client.say(f'Restricted')
+    if settings.enabled:
+        await client.say(str(await sweep_restricted_channels(ctx.message.server, channel_ids)))
 
 
 @voice_bot.command(name='release', pass_context=True)
-async def _release(ctx, channel):
-    if not settings.authorize_command(ctx.message.author):
+async def _release(ctx, channel, target=None):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
         return
     if channel.lower() == 'help':
-        await client.say('Releases a Voice Channel from any restrictions.\n\n'
-                         '!voice_bot release numeric_channel_id')
+        await client.say('Releases a Voice Channel or channel name pattern from any restrictions.\n\n'
+                         '!voice_bot release numeric_channel_id\n'
+                         '!voice_bot release pattern "lobby-*"')
         return
-    if settings.release_channel(channel):
+    if channel.lower() == 'pattern' and target is not None:
+        if settings.release_pattern(target):
+            await client.say('Pattern Released!')
+    elif settings.release_channel(channel):
         await client.say('Channel Released!')
 
 
+@voice_bot.command(name='alias', pass_context=True)
+async def _alias(ctx, mode, alias=None, game=None):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
+        return
+    if mode.lower() == 'add' and alias is not None and game is not None:
+        if settings.alias_game(alias, game):
+            await client.say(f'{alias} now counts as {game}')
+        else:
+            await client.say(f'Invalid alias: {alias}')
+    elif mode.lower() == 'remove' and alias is not None:
+        if settings.remove_game_alias(alias):
+            await client.say(f'Removed alias {alias}')
+        else:
+            await client.say(f'No such alias: {alias}')
+    elif mode.lower() == 'list':
+        await say_page('Game Aliases', (f'{alias} -> {game}' for alias, game in settings.game_aliases.items()),
+                       page_number([alias] if alias is not None else []), '!voice_bot alias list')
+    else:
+        await client.say('Treat an alternate game name as the given game.\n\n'
+                         '!voice_bot alias add "alias" "game"\n'
+                         '!voice_bot alias remove "alias"\n'
+                         '!voice_bot alias list')
+
+
+@voice_bot.command(name='reload', pass_context=True)
+async def _reload(ctx):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
+        return
+    try:
+        reloaded, duration = await guilds.reload(guilds.get(ctx.message.server), force=True)
+    except (OSError, sqlite3.Error, pickle.UnpicklingError, EOFError, ValueError) as e:
+        await client.say(f'Failed to reload settings: {e!r}')
+        return
+    if not reloaded:
+        await client.say(f'No stored settings found in {settings.store}')
+        return
+    await client.say(f'Settings reloaded in {duration * 1000:.1f}ms')
+    if settings.enabled:
+        await client.say(str(await sweep_restricted_channels(ctx.message.server)))
+
+
+def status_lines(state, server):
+    settings = state.settings
+    yield f'Enabled: {settings.enabled}'
+    yield f'Kick Mode Enabled: {settings.kick_mode}'
+    yield f'Bot Admin Role ID: {settings.bot_admin_role_id}'
+    yield f'Game Close Disconnect Timeout: {settings.game_close_disconnect_timeout}s'
+    yield f'Pending Grace Period Checks: {len(state.grace_checks)}'
+    yield f'Cached Member States: {len(state.members)}'
+    yield f'Verdict Cache: {len(state.verdicts)} entries, {state.verdicts.stats["hit_rate"]:.0%} hit rate'
+    yield f'Tracked Twitch Streams: {len(state.streamers)}'
+    yield (f'Events Received/Filtered/Debounced/Evaluated: {events_total.value(stage="received")}/'
+           f'{events_total.value(stage="filtered")}/{events_total.value(stage="debounced")}/'
+           f'{events_total.value(stage="evaluated")}')
+    yield (f'Check Latency: avg {check_seconds.mean() * 1000:.2f}ms, '
+           f'p99 <= {check_seconds.quantile(0.99) * 1000:g}ms')
+    yield (f'Twitch Requests: {twitch_requests_total.total()} '
+           f'(avg {twitch_request_seconds.mean(endpoint="/streams") * 1000:.0f}ms for streams)')
+    yield (f'Discord Actions: {actions_total.total()} '
+           f'({actions_total.value(kind="move", result="ok")} moves, '
+           f'{actions_total.value(kind="mute", result="ok")} mutes)')
+    yield f'Event Loop Lag: {loop_lag_seconds.value() * 1000:.1f}ms'
+    yield (f'Twitch Cache Hit Rate: users {twitch.user_ids.hit_rate:.0%}, '
+           f'games {twitch.channel_games.hit_rate:.0%}')
+    yield f'Whitelisted User IDs ({len(settings.whitelisted_user_ids)}):'
+    yield from settings.whitelisted_user_ids
+    yield f'Whitelisted Role IDs ({len(settings.whitelisted_role_ids)}):'
+    yield from settings.whitelisted_role_ids
+    yield 'Restricted Voice Channels:'
+    yield from restriction_lines(server, settings)
+
+
 @voice_bot.command(name='status', pass_context=True)
-async def _status(ctx):
-    if not settings.authorize_command(ctx.message.author):
-        return
-    whitelisted_users = ', '.join(settings.whitelisted_user_ids)
-    whitelisted_roles = ', '.join(settings.whitelisted_role_ids)
-    restricted_channels = ''
-    for channel, games in settings.restricted_voice_channels.items():
-        channel = client.get_channel(channel)
-        games = ', '.join(games)
-        restricted_channels += f'{channel.name} ({channel.id}) -- {games}\n'
-    await client.say(f'**Status:**\n'
-                     '```'
-                     f'Enabled: {settings.enabled}\n'
-                     f'Kick Mode Enabled: {settings.kick_mode}\n'
-                     f'Bot Admin Role ID: {settings.bot_admin_role_id}\n'
-                     f'Whitelisted User IDs: {whitelisted_users}\n'
-                     f'Whitelisted Role IDs: {whitelisted_roles}\n'
-                     f'Game Close Disconnect Timeout: {settings.game_close_disconnect_timeout}s\n'
-                     f'Restricted Voice Channels:\n\n{restricted_channels}'
-                     '```')
-
-
-def configure_logger(log_level, log_file_path):
+async def _status(ctx, page='1'):
+    if ctx.message.server is None:
+        return
+    state = guilds.get(ctx.message.server)
+    if not state.settings.authorize_command(ctx.message.author):
+        return
+    await say_page('Status:', status_lines(state, ctx.message.server), page_number([page]), '!voice_bot status')
+
+
+@voice_bot.command(name='export', pass_context=True)
+async def _export(ctx, file_format='json'):
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
+        return
+    document = export_policy(settings)
+    if file_format.lower() in ('yaml', 'yml'):
+        if yaml is None:
+            await client.say('YAML export needs PyYAML installed. Use `!voice_bot export json` instead.')
+            return
+        data, extension = yaml.safe_dump(document, default_flow_style=False).encode(), 'yaml'
+    elif file_format.lower() == 'json':
+        data, extension = json.dumps(document, indent=2).encode(), 'json'
+    else:
+        await client.say(f'Invalid format: {file_format}. `json` or `yaml` only.')
+        return
+    await client.send_file(ctx.message.channel, io.BytesIO(data),
+                           filename=f'voice_bot_policy.{ctx.message.server.id}.{extension}',
+                           content='Current voice bot policy.')
+
+
+async def fetch_attachment(url, timeout=10):
+    session = aiohttp.ClientSession()
+    try:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                raise ValueError(f'Downloading the attachment returned HTTP {resp.status}')
+            return await asyncio.wait_for(resp.read(), timeout)
+    finally:
+        await session.close()
+
+
+@voice_bot.command(name='import', pass_context=True)
+async def _import(ctx):
+    max_policy_file_size = 1024 * 1024
+    settings = guild_settings(ctx)
+    if settings is None or not settings.authorize_command(ctx.message.author):
+        return
+    if not ctx.message.attachments:
+        await client.say('Attach a JSON or YAML policy file (see `!voice_bot export`) to the import command.')
+        return
+    attachment = ctx.message.attachments[0]
+    if attachment.get('size', 0) > max_policy_file_size:
+        await client.say('The policy file is too large.')
+        return
+    try:
+        data = await asyncio.wait_for(fetch_attachment(attachment['url']), 10)
+        policy = validate_policy(parse_policy_file(attachment['filename'], data))
+        check_policy_channels(ctx.message.server, settings.settings, policy)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await client.say(f'Failed to download the policy file: {e!r}')
+        return
+    except ValueError as e:
+        await client.say(f'Invalid policy file, nothing was changed. {e}')
+        return
+    started = time.monotonic()
+    settings.apply_policy(policy)
+    await client.say(f'Imported {len(policy)} setting(s) in {(time.monotonic() - started) * 1000:.1f}ms.')
+    if settings.enabled:
+        await client.say(str(await sweep_restricted_channels(ctx.message.server)))
+
+
+def configure_logger(log_level, log_file_path, log_format='text', sample_rate=1.0):
     from sys import stdout
-    log_format = logging.Formatter('%(asctime)s :: %(levelname)s: %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
+    if log_format == 'json':
+        formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    else:
+        formatter = logging.Formatter('%(asctime)s :: %(levelname)s: %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
     logger.setLevel(log_level)
     console_handler = logging.StreamHandler(stdout)
-    console_handler.setFormatter(log_format)
-    logger.addHandler(console_handler)
+    console_handler.setFormatter(formatter)
+    handlers = [console_handler]
 
     if log_file_path is not None:
         file_handler = RotatingFileHandler(log_file_path, maxBytes=5 * (1024 ** 2), backupCount=5)
-        file_handler.setFormatter(log_format)
-        logger.addHandler(file_handler)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue()
+    queue_handler = BackgroundQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 def main():
     args = parse_args()
-    configure_logger(args.log_level, args.log_file)
+    log_listener = configure_logger(args.log_level, args.log_file, args.log_format, args.log_sample_rate)
     if args.settings is not None:
-        settings.file_path = args.settings
+        guilds.settings_path = args.settings
+    if args.database is not None:
+        guilds.database = audit_log.database = SettingsDatabase(args.database)
+    runtime.path = args.runtime_state
+    if runtime.path is None:
+        runtime_file = 'bot_runtime.json' if args.shard_count is None else f'bot_runtime.{args.shard_id or 0}.json'
+        runtime.path = os.path.join(os.path.dirname(os.path.abspath(guilds.settings_path)), runtime_file)
+    runtime.load()
+    if args.shard_count is not None:
+        client.shard_id = args.shard_id or 0
+        client.shard_count = args.shard_count
     logger.info('====== Discord Voice Chat Manager ======')
-    if not settings.claimed:
-        settings.claim_code = str(uuid4())
-        logger.warning(f'THIS BOT IS UNCLAIMED')
-        logger.warning(f'To claim this bot run this command:\n\n'
-                       f'!voice_bot claim {settings.claim_code} @bot_admin_role')
-    client.run(DISCORD_BOT_TOKEN)
+    if args.workers > 0:
+        # Workers must not inherit the gateway's event loop, sockets or logging threads.
+        multiprocessing.set_start_method('spawn')
+        decisions.start(args.workers)
+    lag_monitor = client.loop.create_task(monitor_event_loop_lag())
+    runtime_saver = client.loop.create_task(runtime.run())
+    stream_checker = None
+    if args.stream_check_interval > 0:
+        stream_checker = client.loop.create_task(revalidate_streams(args.stream_check_interval))
+    settings_watcher = None
+    if args.reload_interval > 0:
+        settings_watcher = client.loop.create_task(guilds.watch_settings(args.reload_interval))
+    if args.metrics_port is not None:
+        client.loop.run_until_complete(asyncio.start_server(serve_metrics, '127.0.0.1', args.metrics_port))
+        logger.info(f'Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics')
+    try:
+        client.loop.run_until_complete(client.start(DISCORD_BOT_TOKEN))
+    except KeyboardInterrupt:
+        client.loop.run_until_complete(client.logout())
+    finally:
+        lag_monitor.cancel()
+        runtime_saver.cancel()
+        client.loop.run_until_complete(runtime.save())
+        if settings_watcher is not None:
+            settings_watcher.cancel()
+        if stream_checker is not None:
+            stream_checker.cancel()
+        decisions.close()
+        client.loop.run_until_complete(twitch.close())
+        client.loop.run_until_complete(guilds.close())
+        client.loop.run_until_complete(audit_log.close())
+        if guilds.database is not None:
+            guilds.database.close()
+        client.loop.close()
+        log_listener.stop()
 
 
 if __name__ == '__main__':
     main()
-    client.close()